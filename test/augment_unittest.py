@@ -0,0 +1,29 @@
+import unittest
+import numpy as np
+from vessel.augment import Compose, RandomCrop, RandomFlip, RandomRot90, IntensityJitter, WindowLevel
+
+
+class TestAugment(unittest.TestCase):
+    def test_masks_follow_image(self):
+        batch_x = np.random.RandomState(0).rand(16, 32, 32).astype(np.float32)
+        batch_y = np.stack([batch_x > 0.5, batch_x > 0.8], axis=1)
+        transform = Compose([RandomCrop(24, 20), RandomFlip(), RandomRot90()])
+        x, y = transform(batch_x, batch_y, np.random.RandomState(1))
+        self.assertEqual(x.shape, (16, 24, 20))
+        self.assertEqual(y.shape, (16, 2, 24, 20))
+        self.assertTrue((y[:, 0] == (x > 0.5)).all())
+        self.assertTrue((y[:, 1] == (x > 0.8)).all())
+        # same rng seed, same batch
+        again, _ = transform(batch_x, batch_y, np.random.RandomState(1))
+        self.assertTrue((again == x).all())
+
+    def test_intensity(self):
+        batch_x = np.random.RandomState(0).randint(-1000, 1000, size=(4, 8, 8)).astype(np.int16)
+        batch_y = batch_x > 0
+        x, y = Compose([IntensityJitter(), WindowLevel(0, 1000)])(batch_x, batch_y, np.random.RandomState(0))
+        self.assertEqual(x.dtype, np.float32)
+        self.assertTrue(0 <= x.min() and x.max() <= 1)
+        self.assertIs(y, batch_y)
+
+if __name__ == '__main__':
+    unittest.main()
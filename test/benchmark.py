@@ -0,0 +1,311 @@
+"""Throughput / latency benchmark of the loaders on a synthetic dataset
+
+No patient data is needed, a dataset in the FileFeeder layout is generated first.
+Every scenario runs in a fresh process, results are written as json lines, e.g.
+
+    python3 test/benchmark.py --workers 1 2 4 --batch-sizes 8 32 --cache-sizes 4 20 --output bench.jsonl
+
+Measured for every scenario:
+    samples_per_sec     samples / wall time (the first batch excluded)
+    first_batch_ms      time until the first batch
+    latency_p50_ms, latency_p99_ms
+                        time between two batches seen by the consumer
+    peak_rss_mb         peak RSS of the scenario process, peak_rss_workers_mb of its workers
+    bytes_copied        bytes of batch data copied on the way to consumer (estimated):
+                        assembly 1x, 'queue' transport +2x (pickle, unpickle), 'shm' transport +1x
+Parser stages (loader 'parser') are timed on the contours of the dataset:
+    us_per_item         microseconds per contour file ('coords', 'coords_batch') or mask, 'pil_round_trip' is the
+                        Image.new / np.array / astype(bool) mask creation used before as reference
+"""
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+import platform
+import resource
+import tempfile
+import itertools
+import logging
+import multiprocessing as mp
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import vessel.configuration as config
+from vessel.parser import DICOMParser
+from vessel.preprocess import FileFeeder, DICOMFileIterator
+from vessel.utils import GeneratorQueue
+
+
+def _element(group, element, vr, value):
+    """explicit VR little endian data element"""
+    if len(value) % 2:
+        value += b'\0' if vr in (b'UI', b'OB') else b' '
+    tag = struct.pack('<HH', group, element)
+    if vr in (b'OB', b'OW'):
+        return tag + vr + b'\0\0' + struct.pack('<I', len(value)) + value
+    return tag + vr + struct.pack('<H', len(value)) + value
+
+
+def write_dicom(filename, pixels, patient_id, instance_number, slope=None, intercept=None):
+    """Write a minimal DICOM file (explicit VR little endian, 16 bits MONOCHROME2)"""
+    height, width = pixels.shape
+    transfer_syntax = b'1.2.840.10008.1.2.1'
+    meta = (_element(0x0002, 0x0001, b'OB', b'\0\1') +
+            _element(0x0002, 0x0002, b'UI', b'1.2.840.10008.5.1.4.1.1.4') +
+            _element(0x0002, 0x0003, b'UI', '1.2.3.{}.{}'.format(
+                int(''.join(c for c in patient_id if c.isdigit()) or 0), instance_number).encode()) +
+            _element(0x0002, 0x0010, b'UI', transfer_syntax))
+    meta = _element(0x0002, 0x0000, b'UL', struct.pack('<I', len(meta))) + meta
+
+    dataset = (_element(0x0008, 0x0016, b'UI', b'1.2.840.10008.5.1.4.1.1.4') +
+               _element(0x0010, 0x0020, b'LO', patient_id.encode()) +
+               _element(0x0020, 0x0013, b'IS', str(instance_number).encode()) +
+               _element(0x0028, 0x0002, b'US', struct.pack('<H', 1)) +
+               _element(0x0028, 0x0004, b'CS', b'MONOCHROME2') +
+               _element(0x0028, 0x0010, b'US', struct.pack('<H', height)) +
+               _element(0x0028, 0x0011, b'US', struct.pack('<H', width)) +
+               _element(0x0028, 0x0100, b'US', struct.pack('<H', 16)) +
+               _element(0x0028, 0x0101, b'US', struct.pack('<H', 16)) +
+               _element(0x0028, 0x0102, b'US', struct.pack('<H', 15)) +
+               _element(0x0028, 0x0103, b'US', struct.pack('<H', 0)))
+    if slope is not None and intercept is not None:
+        dataset += (_element(0x0028, 0x1052, b'DS', str(intercept).encode()) +
+                    _element(0x0028, 0x1053, b'DS', str(slope).encode()))
+    dataset += _element(0x7FE0, 0x0010, b'OW', pixels.astype('<u2').tobytes())
+
+    with open(filename, 'wb') as fp_dcm:
+        fp_dcm.write(b'\0' * 128 + b'DICM' + meta + dataset)
+
+
+def make_dataset(directory, patients=4, slices=64, size=256, contour_every=3, seed=0):
+    """Generate a synthetic dataset in the FileFeeder layout
+       every `contour_every`-th slice has an i-contour, every 2 * `contour_every`-th one an o-contour too
+    """
+    rng = np.random.RandomState(seed)
+    dicoms_path = os.path.join(directory, config.IOConfig['dicoms_folder'])
+    contour_path = os.path.join(directory, config.IOConfig['contour_folder'])
+    links = []
+    for p in range(patients):
+        patient_id, contour_id = 'SCD{:05d}'.format(p), 'SC-{:05d}'.format(p)
+        links.append('{},{}'.format(patient_id, contour_id))
+        dicom_folder = os.path.join(dicoms_path, patient_id)
+        i_folder = os.path.join(contour_path, contour_id, config.IOConfig['inner_contour_folder'])
+        o_folder = os.path.join(contour_path, contour_id, config.IOConfig['outter_contour_folder'])
+        for folder in (dicom_folder, i_folder, o_folder):
+            os.makedirs(folder, exist_ok=True)
+
+        for i in range(1, slices + 1):
+            pixels = rng.randint(0, 2000, size=(size, size))
+            write_dicom(os.path.join(dicom_folder, '{}.dcm'.format(i)), pixels, patient_id, i, 1, -1024)
+            if i % contour_every:
+                continue
+            t = np.linspace(0, 2 * np.pi, 120, endpoint=False)
+            radius = size * (0.1 + 0.05 * rng.rand())
+            center = size / 2 + rng.randn(2) * size * 0.05
+            for folder, scale, kind in ((i_folder, 1.0, 'i'), (o_folder, 1.3, 'o')):
+                if kind == 'o' and i % (2 * contour_every):
+                    continue
+                coords = center + scale * radius * np.c_[np.cos(t), np.sin(t)]
+                contour_file = os.path.join(folder, 'IM-0001-{:04d}-{}contour-manual.txt'.format(i, kind))
+                np.savetxt(contour_file, coords, fmt='%.2f')
+
+    with open(os.path.join(directory, config.IOConfig['link_file']), 'w') as fp_link:
+        fp_link.write('patient_id,original_id\n')
+        fp_link.write('\n'.join(links) + '\n')
+
+
+def _nbytes(batch):
+    if isinstance(batch, np.ndarray):
+        return batch.nbytes
+    if isinstance(batch, (tuple, list)):
+        return sum(_nbytes(item) for item in batch)
+    return 0
+
+
+def _measure(next_batch, n_batches, batch_size=lambda batch: len(batch[0])):
+    """
+    :return: (samples, bytes of batches, first batch seconds, seconds of the rest, latencies)
+    """
+    start = time.perf_counter()
+    batch = next_batch()
+    first_batch = time.perf_counter() - start
+    samples, nbytes = 0, 0
+    latencies = []
+    start = last = time.perf_counter()
+    for _ in range(n_batches - 1):
+        batch = next_batch()
+        now = time.perf_counter()
+        latencies.append(now - last)
+        last = now
+        samples += batch_size(batch)
+        nbytes += _nbytes(batch)
+    return samples, nbytes, first_batch, last - start, latencies
+
+
+def _run_scenario(data, scenario, n_batches):
+    """runs inside a fresh process
+    :return: dict of results
+    """
+    logging.getLogger('vessel.utils').setLevel(logging.WARNING)
+    config.Performance['max_workers'] = scenario['workers']
+    config.Performance['cache_size'] = scenario['cache_size']
+    dtype = None if scenario['dtype'] == 'none' else np.dtype(scenario['dtype'])
+    copies = 1
+
+    feeder = FileFeeder(data)
+    queue = None
+    try:
+        if scenario['loader'] == 'feeder':
+            # FileFeeder yields one (image, mask) at a time and stops after one pass
+            result = _measure(feeder.__next__, min(n_batches, len(feeder)), lambda batch: 1)
+        else:
+            iterator = DICOMFileIterator(feeder.files(), scenario['batch_size'], seed=0, dtype=dtype)
+            if scenario['loader'] == 'iterator':
+                result = _measure(iterator.next, n_batches)
+            else:
+                queue = GeneratorQueue(iterator, transport=scenario['transport'])
+                queue.start()
+                copies += 2 if scenario['transport'] == 'queue' else 1
+                result = _measure(queue.fetch().__next__, n_batches)
+    finally:
+        if queue is not None:
+            queue.stop()
+            for p in mp.active_children():
+                p.join()
+
+    samples, nbytes, first_batch, seconds, latencies = result
+    latencies = np.array(latencies) * 1000
+    return dict(scenario,
+        samples=samples,
+        seconds=seconds,
+        samples_per_sec=samples / seconds if seconds else None,
+        first_batch_ms=first_batch * 1000,
+        latency_p50_ms=float(np.percentile(latencies, 50)) if len(latencies) else None,
+        latency_p99_ms=float(np.percentile(latencies, 99)) if len(latencies) else None,
+        # ru_maxrss is in kilobytes on linux
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        peak_rss_workers_mb=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        bytes_copied=nbytes * copies
+    )
+
+
+def _per_item_us(fn, items, repeat):
+    """best of repeat runs of fn(), microseconds per item"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best / items * 1e6
+
+
+def _pil_mask(coords, width, height):
+    img = Image.new(mode='L', size=(width, height), color=0)
+    ImageDraw.Draw(img).polygon(xy=coords.ravel().tolist(), outline=0, fill=1)
+    return np.array(img).astype(bool)
+
+
+def parser_stages(data, repeat=5):
+    """time contour parsing and mask rasterization, the parser cache is disabled
+    :return: list of dict, one for each stage
+    """
+    files = FileFeeder(data).files()
+    contours = [group[1] for group in files if group[1]]
+    header = DICOMParser.Header(files[0][0])
+    width, height = header['width'], header['height']
+    coords_lst = DICOMParser.CoordsBatch(contours)
+    out = np.zeros((len(contours), height, width), dtype=bool)
+
+    stages = {
+        'coords': lambda: [DICOMParser.Coords(contour) for contour in contours],
+        'coords_batch': lambda: DICOMParser.CoordsBatch(contours),
+        'pil_round_trip': lambda: [_pil_mask(coords, width, height) for coords in coords_lst],
+        'rasterize': lambda: [DICOMParser.Rasterize(coords, width, height) for coords in coords_lst],
+        'rasterize_batch': lambda: DICOMParser.RasterizeBatch(coords_lst, width, height, out=out),
+        'create_mask': lambda: [DICOMParser.CreateMask(contour, width, height) for contour in contours],
+    }
+    cache_bytes = config.Performance['parser_cache_bytes']
+    config.Performance['parser_cache_bytes'] = 0
+    try:
+        return [{'loader': 'parser', 'stage': stage, 'items': len(contours), 'width': width, 'height': height,
+                 'us_per_item': _per_item_us(fn, len(contours), repeat)}
+                for stage, fn in stages.items()]
+    finally:
+        config.Performance['parser_cache_bytes'] = cache_bytes
+
+
+def _scenario_process(data, scenario, n_batches, conn):
+    try:
+        conn.send(_run_scenario(data, scenario, n_batches))
+    except Exception as e:
+        conn.send(dict(scenario, error=repr(e)))
+    finally:
+        conn.close()
+
+
+def scenarios(args):
+    yield {'loader': 'feeder', 'workers': 0, 'batch_size': 1, 'cache_size': 0,
+           'transport': None, 'dtype': args.dtype}
+    for batch_size in args.batch_sizes:
+        yield {'loader': 'iterator', 'workers': 0, 'batch_size': batch_size, 'cache_size': 0,
+               'transport': None, 'dtype': args.dtype}
+    for workers, batch_size, cache_size, transport in itertools.product(
+            args.workers, args.batch_sizes, args.cache_sizes, args.transports):
+        yield {'loader': 'queue', 'workers': workers, 'batch_size': batch_size, 'cache_size': cache_size,
+               'transport': transport, 'dtype': args.dtype}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', help='synthetic dataset folder, generated if it does not exist')
+    parser.add_argument('--patients', type=int, default=4)
+    parser.add_argument('--slices', type=int, default=64, help='slices per patient')
+    parser.add_argument('--size', type=int, default=256, help='height and width of slices')
+    parser.add_argument('--batches', type=int, default=50, help='batches per scenario')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[8, 32])
+    parser.add_argument('--cache-sizes', type=int, nargs='+', default=[4, 20])
+    parser.add_argument('--transports', nargs='+', default=['queue', 'shm'])
+    parser.add_argument('--dtype', default='float32', help="dtype of dense batches, 'none' for legacy batches")
+    parser.add_argument('--output', help='json lines file, default: stdout')
+    parser.add_argument('--no-parser', dest='parser', action='store_false',
+                        help='skip the contour parsing / rasterization stages')
+    args = parser.parse_args()
+
+    data = args.data or os.path.join(tempfile.gettempdir(), 'vessel_benchmark_{}x{}x{}'.format(
+        args.patients, args.slices, args.size))
+    if not os.path.exists(os.path.join(data, config.IOConfig['link_file'])):
+        make_dataset(data, args.patients, args.slices, args.size)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        header = {
+            'benchmark': 'vessel', 'time': time.time(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'cpus': os.cpu_count(), 'data': data,
+            'patients': args.patients, 'slices': args.slices, 'size': args.size, 'batches': args.batches
+        }
+        output.write(json.dumps(header) + '\n')
+        ctx = mp.get_context('fork')
+        if args.parser:
+            for result in parser_stages(data):
+                output.write(json.dumps(result) + '\n')
+        for scenario in scenarios(args):
+            receiver, sender = ctx.Pipe(duplex=False)
+            p = ctx.Process(target=_scenario_process, args=(data, scenario, args.batches, sender))
+            p.start()
+            sender.close()
+            result = receiver.recv()
+            p.join()
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import os
+import json
+import unittest
+import tempfile
+import numpy as np
+from vessel.preprocess import FileFeeder, DICOMFileIterator
+from vessel.cache import SliceCache
+from vessel.parser import DICOMParser
+from vessel.utils import LRUCache
+
+class TestSliceCache(unittest.TestCase):
+    def test_cached_batches(self):
+        feeder = FileFeeder('data')
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = SliceCache.build(feeder.files(), cache_dir)
+            self.assertEqual(len(cache), len(feeder))
+
+            plain = DICOMFileIterator(x=feeder.files(), batch_size=8)
+            cached = DICOMFileIterator(x=feeder.files(), batch_size=8, cache=cache)
+            index_array = np.arange(16)
+            for (img, mask), (cached_img, cached_mask) in zip(plain._read_samples(index_array),
+                                                              cached._read_samples(index_array)):
+                self.assertTrue(np.allclose(img, cached_img))
+                if mask is None:
+                    self.assertIsNone(cached_mask)
+                else:
+                    self.assertTrue((mask == cached_mask).all())
+
+    def test_interrupted_rebuild(self):
+        feeder = FileFeeder('data')
+        files = feeder.files()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = SliceCache.build(files, cache_dir)
+            expected = cache.read(np.arange(len(files)))
+            read_dicom = DICOMParser.ReadDICOM
+
+            def broken_read(*args, **kwargs):
+                if broken_read.calls == 10:
+                    raise KeyboardInterrupt()
+                broken_read.calls += 1
+                return read_dicom(*args, **kwargs)
+            broken_read.calls = 0
+            DICOMParser.ReadDICOM = staticmethod(broken_read)
+            try:
+                with self.assertRaises(KeyboardInterrupt):
+                    SliceCache.build(files[::-1], cache_dir)
+            finally:
+                DICOMParser.ReadDICOM = staticmethod(read_dicom)
+            # the interrupted build left the old cache as it was, no temporary file behind
+            self.assertEqual(sorted(os.listdir(cache_dir)),
+                             sorted([SliceCache.PIXELS_FILE, SliceCache.MASKS_FILE, SliceCache.INDEX_FILE]))
+            reopened = SliceCache(cache_dir)
+            for (img, mask), (cached_img, cached_mask) in zip(expected, reopened.read(reopened.rows(files))):
+                self.assertTrue((img == cached_img).all())
+                self.assertTrue(mask is None and cached_mask is None or (mask == cached_mask).all())
+            # the memmaps opened before the rebuild still read the old arrays
+            self.assertTrue((cache.read([0])[0][0] == expected[0][0]).all())
+
+    def test_index_version(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # an index without version, e.g. of a cache built before versions were recorded
+            with open(os.path.join(cache_dir, SliceCache.INDEX_FILE), 'w') as fp_index:
+                json.dump({'entries': [], 'masks': 'i'}, fp_index)
+            with self.assertRaises(IOError):
+                SliceCache(cache_dir)
+
+    def test_lru_byte_budget(self):
+        cache = LRUCache(max_bytes=100)
+        cache.put('a', 'A', 40)
+        cache.put('b', 'B', 40)
+        self.assertEqual(cache.get('a'), 'A')
+        # 'b' is the least recently used one
+        cache.put('c', 'C', 40)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 'C')
+        # larger than the whole budget, never cached
+        cache.put('d', 'D', 101)
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertEqual(cache.current_bytes, 80)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,22 @@
+import os
+import json
 import unittest
+import multiprocessing as mp
+import numpy as np
 from vessel.preprocess import FileFeeder
-from vessel.preprocess import DICOMFileIterator
+from vessel.preprocess import DICOMFileIterator, VolumeIterator, DistributedFileIterator
+from vessel.parser import DICOMParser
+import vessel.configuration as config
+
+# 7 patients with 3 to 13 slices, only paths, nothing is read
+FAKE_FILES = np.array([['dicoms/SCD{:04d}/{}.dcm'.format(p, i), None, None]
+                       for p in range(7) for i in range(1, (p * 5) % 11 + 4)], dtype=object)
+
+
+def shard_epochs(rank, world_size=3, epochs=3):
+    """runs in a process standing in for a node"""
+    itert = DistributedFileIterator(FAKE_FILES, 4, rank, world_size, seed=9)
+    return [np.concatenate([next(itert.index_generator) for _ in range(len(itert))]) for _ in range(epochs)]
 
 class TestFileFeeder(unittest.TestCase):
     def test_link_building(self):
@@ -35,5 +51,156 @@ class TestFileFeeder(unittest.TestCase):
             print(batch_x.shape, batch_y.shape)
             n -= 1
 
+    def test_dense_batches(self):
+        feeder = FileFeeder('data')
+        itert = DICOMFileIterator(x=feeder.files(), batch_size=8, dtype=np.float32)
+        for _ in range(20):
+            batch_x, batch_y, valid = next(itert)
+            self.assertEqual(batch_x.dtype, np.float32)
+            self.assertEqual(batch_y.dtype, bool)
+            self.assertEqual(batch_x.shape, batch_y.shape)
+            self.assertEqual(valid.shape, (batch_x.shape[0], ))
+            # slices without mask are all False
+            self.assertFalse(batch_y[~valid].any())
+
+    def test_metadata(self):
+        feeder = FileFeeder('data')
+        metadata = feeder.metadata()
+        self.assertEqual(len(metadata), len(feeder))
+        self.assertEqual(metadata[0]['width'], DICOMParser.Pixel(feeder.files()[0][0])['width'])
+        # the persisted index gives the same result
+        self.assertEqual(FileFeeder('data').metadata(), metadata)
+        # a truncated index is rebuilt
+        with open(os.path.join('data', config.IOConfig['metadata_file']), 'r+') as fp_meta:
+            fp_meta.truncate(10)
+        self.assertEqual(FileFeeder('data').metadata(), metadata)
+        patient = feeder.select(lambda meta: meta['patient_id'] == 'SCD0000401')
+        self.assertEqual(len(patient), 220)
+
+    def test_scan_manifest(self):
+        feeder = FileFeeder('data')
+        # the second scan is restored from scan_manifest.json
+        rescanned = FileFeeder('data')
+        self.assertTrue((rescanned.files() == feeder.files()).all())
+        self.assertEqual(len(rescanned._patient_files['SCD0000401']['dicoms']), 220)
+        # a truncated manifest (e.g. a crashed writer) is ignored and rewritten
+        manifest_file = os.path.join('data', config.IOConfig['scan_manifest'])
+        with open(manifest_file, 'r+') as fp_manifest:
+            fp_manifest.truncate(10)
+        self.assertTrue((FileFeeder('data').files() == feeder.files()).all())
+        with open(manifest_file, 'r') as fp_manifest:
+            json.load(fp_manifest)
+
+    def test_threaded_decode(self):
+        feeder = FileFeeder('data')
+        sequential = DICOMFileIterator(x=feeder.files(), batch_size=8, seed=1, dtype=np.float32)
+        threaded = DICOMFileIterator(x=feeder.files(), batch_size=8, seed=1, dtype=np.float32)
+        config.Performance['decode_threads'] = 4
+        try:
+            for _ in range(5):
+                expected = sequential._process_batch_data(next(sequential.index_generator))
+                batch = threaded.next()
+                for a, b in zip(expected, batch):
+                    self.assertTrue((a == b).all())
+        finally:
+            config.Performance['decode_threads'] = 0
+
+    def test_bucket_by_size(self):
+        feeder = FileFeeder('data')
+        itert = DICOMFileIterator(x=feeder.files(), batch_size=8, dtype=np.float32,
+                                  bucket_by_size=True, metadata=feeder.metadata())
+        indices = []
+        for _ in range(len(itert)):
+            index_array = next(itert.index_generator)
+            sizes = set((meta['width'], meta['height']) for meta in np.array(feeder.metadata())[index_array])
+            self.assertEqual(len(sizes), 1)
+            indices.extend(index_array)
+        # every slice once per epoch
+        self.assertEqual(sorted(indices), list(range(len(feeder))))
+
+    def test_packed_masks(self):
+        feeder = FileFeeder('data')
+        dense = DICOMFileIterator(x=feeder.files(), batch_size=8, seed=1, dtype=np.float32)
+        packed = DICOMFileIterator(x=feeder.files(), batch_size=8, seed=1, dtype=np.float32, pack_masks=True)
+        for _ in range(5):
+            batch_x, batch_y, _ = next(dense)
+            _, packed_y, _ = next(packed)
+            self.assertEqual(packed_y.dtype, np.uint8)
+            self.assertTrue((DICOMFileIterator.unpack_masks(packed_y, batch_x.shape[-1]) == batch_y).all())
+
+    def test_io_masks(self):
+        feeder = FileFeeder('data')
+        for dicom_file, i_contour, o_contour in feeder.files():
+            if i_contour and o_contour:
+                break
+        _, masks = DICOMParser.ReadDICOM(dicom_file, i_contour, o_contour, masks='io')
+        _, i_mask = DICOMParser.ReadDICOM(dicom_file, i_contour, o_contour)
+        _, o_mask = DICOMParser.ReadDICOM(dicom_file, i_contour, o_contour, masks='o')
+        self.assertEqual(masks.shape, (2, ) + i_mask.shape)
+        self.assertTrue((masks[0] == i_mask).all())
+        self.assertTrue((masks[1] == o_mask).all())
+
+        itert = DICOMFileIterator(x=feeder.files(), batch_size=8, dtype=np.float32, masks='io')
+        batch_x, batch_y, valid = next(itert)
+        self.assertEqual(batch_y.shape, (batch_x.shape[0], 2) + batch_x.shape[1:])
+        self.assertEqual(valid.shape, (batch_x.shape[0], 2))
+
+    def test_contour_sampling(self):
+        feeder = FileFeeder('data')
+        labeled = feeder.with_contours(['i', 'io'])
+        self.assertTrue(all(group[1] for group in labeled))
+
+        classes = FileFeeder.contour_classes(feeder.files())
+        itert = DICOMFileIterator(x=feeder.files(), batch_size=8, seed=1, contour_weights={'i': 1, 'io': 1})
+        drawn = classes[np.concatenate([next(itert.index_generator) for _ in range(50)])]
+        # slices without i-contour are never decoded
+        self.assertTrue(np.isin(drawn, [1, 3]).all())
+
+    def test_volumes(self):
+        feeder = FileFeeder('data')
+        volumes = feeder.volumes()
+        self.assertEqual(len(volumes['SCD0000401']), 220)
+        positions = [DICOMParser.Header(group[0])['instance_number'] for group in volumes['SCD0000401']]
+        self.assertEqual(positions, sorted(positions))
+
+        itert = VolumeIterator(list(volumes.values()), batch_size=8, context=2, seed=1)
+        index_array = next(itert.index_generator)
+        batch_x, batch_y, valid = itert._process_batch_data(index_array)
+        self.assertEqual(batch_x.shape[:2], (len(index_array), 5))
+        # the centre of a window is the slice itself
+        group = itert.volumes[itert.groups[index_array[0]]][itert._slices[index_array[0]]]
+        image, _ = DICOMParser.ReadDICOM(*group)
+        self.assertTrue((batch_x[0, 2] == image).all())
+
+    def test_volume_batch_order(self):
+        patients = np.array([group[0].split('/')[1] for group in FAKE_FILES])
+        volumes = [FAKE_FILES[patients == p] for p in np.unique(patients)]
+        itert = VolumeIterator(volumes, batch_size=4, context=1, seed=3)
+        orders = []
+        for _ in range(2):
+            groups = [itert.groups[next(itert.index_generator)] for _ in range(len(itert))]
+            self.assertTrue(all(len(set(g)) == 1 for g in groups))
+            # batches of a patient follow each other, every window once
+            order = [g[0] for k, g in enumerate(groups) if k == 0 or g[0] != groups[k - 1][0]]
+            self.assertEqual(sorted(order), list(range(len(volumes))))
+            self.assertEqual(sorted(np.concatenate(groups)), sorted(itert.groups))
+            orders.append(order)
+        # patients are shuffled every epoch
+        self.assertNotEqual(orders[0], orders[1])
+
+    def test_distributed_shards(self):
+        with mp.get_context('fork').Pool(3) as pool:
+            shards = pool.map(shard_epochs, range(3))
+        patients = np.array([group[0].split('/')[1] for group in FAKE_FILES])
+        for epoch in range(3):
+            owned = [set(patients[shard[epoch]]) for shard in shards]
+            # every patient is read by exactly one rank, every rank runs the same number of steps
+            self.assertEqual(sum(len(o) for o in owned), len(set(patients)))
+            self.assertEqual(set.union(*owned), set(patients))
+            self.assertEqual(len(set(len(shard[epoch]) for shard in shards)), 1)
+        # patients are dealt again every epoch
+        self.assertNotEqual([set(patients[shard[0]]) for shard in shards],
+                            [set(patients[shard[1]]) for shard in shards])
+
 if __name__ == '__main__':
     unittest.main()
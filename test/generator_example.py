@@ -12,8 +12,6 @@ def main():
 
     # create file feeder
     feeder = FileFeeder('data')
-    n_of_samples = len(feeder)
-    steps_of_epoch = n_of_samples / batch_size
 
     # generator to generate (pixel_data, mask)
     # it will return:
@@ -38,22 +36,11 @@ def main():
         # use GeneratorQueue to parallel generator
         queue = GeneratorQueue(generator=generator)
         queue.start()
-        # output is our new generator
-        output = queue.fetch()
-
-        epoch = 0
-        while epoch < epochs:
-            steps = 0
+        for epoch in range(epochs):
             print("Epoch-{}".format(epoch))
-            while steps < steps_of_epoch:
-                x, y = next(output)
-                current_batch_size = x.shape[0]
+            # exactly one pass over the generator, the next epoch is already loading meanwhile
+            for steps, (x, y) in enumerate(queue.epoch()):
                 print("Batch-{}, X.shape: {}, Y.shape: {}".format(steps, x.shape, y.shape))
-
-                steps += 1
-            epoch += 1
-            # notify generator to re-shuffle index array
-            generator.event_epoch_end()
     finally:
         queue.stop()
     
@@ -0,0 +1,47 @@
+import os
+import unittest
+import tempfile
+import numpy as np
+from vessel.preprocess import FileFeeder, PackedFileFeeder, DICOMFileIterator
+from vessel.parser import DICOMParser
+
+class TestDatasetPack(unittest.TestCase):
+    def test_packed_batches(self):
+        feeder = FileFeeder('data')
+        with tempfile.TemporaryDirectory() as pack_dir:
+            packed = PackedFileFeeder.pack(feeder, pack_dir, shard_bytes=64 << 20)
+            self.assertEqual(len(packed), len(feeder))
+            self.assertTrue(any(name.startswith('shard-') for name in os.listdir(pack_dir)))
+            # metadata comes from the pack index, no DICOM header is read
+            self.assertEqual(PackedFileFeeder(pack_dir).metadata(), feeder.metadata())
+
+            for group, packed_group in zip(feeder.files()[:20], packed.files()[:20]):
+                for contour, packed_contour in zip(group[1:], packed_group[1:]):
+                    if contour:
+                        self.assertTrue((DICOMParser.Coords(contour) == DICOMParser.Coords(packed_contour)).all())
+
+            plain = DICOMFileIterator(x=feeder.files(), batch_size=8, seed=1, dtype=np.float32, masks='io')
+            from_pack = DICOMFileIterator(x=packed.files(), batch_size=8, seed=1, dtype=np.float32, masks='io')
+            for _ in range(5):
+                for a, b in zip(next(plain), next(from_pack)):
+                    self.assertTrue((a == b).all())
+
+    def test_repack(self):
+        feeder = FileFeeder('data')
+        with tempfile.TemporaryDirectory() as pack_dir:
+            packed = PackedFileFeeder.pack(feeder, pack_dir, shard_bytes=64 << 20)
+            expected = DICOMParser.Pixel(packed.files()[-1][0])['pixel_data']
+            contour = next(group[1] for group in packed.files() if group[1])
+            coords = DICOMParser.Coords(contour)
+            # many small shards, every offset moves
+            repacked = PackedFileFeeder.pack(feeder, pack_dir, shard_bytes=1 << 16)
+            self.assertGreater(len(repacked._pack.index['shards']), len(packed._pack.index['shards']))
+            self.assertEqual(sorted(name for name in os.listdir(pack_dir) if name.startswith('shard-')),
+                             sorted(repacked._pack.index['shards']))
+            self.assertTrue((DICOMParser.Pixel(repacked.files()[-1][0])['pixel_data'] == expected).all())
+            self.assertTrue((DICOMParser.Coords(contour) == coords).all())
+            # arrays viewing the old shards are still readable
+            self.assertEqual(coords.sum(), DICOMParser.Coords(contour).sum())
+
+if __name__ == '__main__':
+    unittest.main()
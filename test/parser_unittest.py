@@ -1,13 +1,83 @@
+import os
+import tempfile
 import unittest
+import numpy as np
+from PIL import Image, ImageDraw
 
 from vessel.parser import DICOMParser
 
+
+def pil_mask(coords, width, height):
+    """the PIL round-trip CreateMask used before"""
+    img = Image.new(mode='L', size=(width, height), color=0)
+    ImageDraw.Draw(img).polygon(xy=np.asarray(coords).ravel().tolist(), outline=0, fill=1)
+    return np.array(img).astype(bool)
+
 class TestParser(unittest.TestCase):  
     def test_dicom_parser(self):
         dicom_parser = DICOMParser()
         self.assertEqual(dicom_parser.Pixel('data/dicoms/SCD0000201/126.dcm')['width'], 256)
         #print(dicom_parser.Coords('data/contourfiles/SC-HF-I-1/i-contours/IM-0001-0048-icontour-manual.txt'))
 
+    def test_coords_parser(self):
+        contents = [
+            '120.50 137.50\n121.50 137.50\n\n122.50 136.50\n',    # space separated
+            '120.50,137.50\n121.50,137.50\n',                       # comma separated
+            '120.50 137.50\nx y\n1 2 3\n1, 2\n  121.50 137.50  \n', # malformed lines are ignored
+            '1. .5\n+ 2\n',                                         # invalid float
+            ''
+        ]
+        expected = [
+            [(120.5, 137.5), (121.5, 137.5), (122.5, 136.5)],
+            [(120.5, 137.5), (121.5, 137.5)],
+            [(120.5, 137.5), (121.5, 137.5)],
+            [(1.0, 0.5)],
+            []
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filenames = []
+            for i, content in enumerate(contents):
+                filename = os.path.join(tmp_dir, '{}.txt'.format(i))
+                with open(filename, 'w') as fp:
+                    fp.write(content)
+                filenames.append(filename)
+
+            for filename, coords, batch_coords, exp in zip(filenames,
+                                                           map(DICOMParser.Coords, filenames),
+                                                           DICOMParser.CoordsBatch(filenames),
+                                                           expected):
+                exp = np.array(exp, dtype=np.float64).reshape(-1, 2)
+                self.assertEqual(coords.shape, exp.shape)
+                self.assertTrue(np.array_equal(coords, exp))
+                self.assertTrue(np.array_equal(batch_coords, exp))
+
+    def test_rasterize_same_as_pil(self):
+        rng = np.random.RandomState(0)
+        width, height = 64, 48
+        polygons = []
+        for i in range(200):
+            n = rng.randint(2, 40)
+            if i % 2:
+                # contour like polygon
+                t = np.sort(rng.uniform(0, 2 * np.pi, n))
+                r = rng.uniform(3, 30)
+                polygons.append(np.c_[32 + r * np.cos(t) + rng.rand(n), 24 + r * np.sin(t) + rng.rand(n)])
+            else:
+                # random, self-intersecting and partly outside of the image
+                polygons.append(rng.uniform(-8, 72, size=(n, 2)))
+
+        expected = np.array([pil_mask(coords, width, height) for coords in polygons])
+        for coords, exp in zip(polygons, expected):
+            self.assertTrue((DICOMParser.Rasterize(coords, width, height) == exp).all())
+
+        masks = np.ones((len(polygons), height, width), dtype=bool)
+        DICOMParser.RasterizeBatch(polygons, width, height, out=masks)
+        self.assertTrue((masks == expected).all())
+
+        packed = np.zeros((len(polygons), height, (width + 7) // 8), dtype=np.uint8)
+        DICOMParser.RasterizeBatch(polygons, width, height, out=packed)
+        self.assertTrue((np.unpackbits(packed, axis=-1, count=width).astype(bool) == expected).all())
+
 
 if __name__ == '__main__':
     unittest.main()
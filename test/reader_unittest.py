@@ -1,6 +1,53 @@
+import time
 import unittest
+import asyncio
+import itertools
+import numpy as np
 from vessel.preprocess import FileFeeder, DICOMFileIterator
-from vessel.utils import GeneratorQueue
+import vessel.configuration as config
+from vessel.utils import GeneratorQueue, SharedBatch, Iterator, MapLoader
+from vessel.stream import AsyncBatchStream
+
+
+class IndexIterator(Iterator):
+    """returns the index array itself as batch, no DICOM needed"""
+    def __init__(self, n, batch_size, seed=None):
+        super().__init__(n, batch_size, True, seed)
+
+    def _process_batch_data(self, index_array, seed=None):
+        return (np.asarray(index_array, dtype=np.float64), np.asarray(index_array))
+
+
+class BrokenIterator(IndexIterator):
+    """samples in broken can't be loaded"""
+    def __init__(self, n, batch_size, broken, seed=None):
+        super().__init__(n, batch_size, seed)
+        self.broken = broken
+
+    def _process_batch_data(self, index_array, seed=None):
+        if np.isin(index_array, self.broken).any():
+            raise IOError("broken sample")
+        return super()._process_batch_data(index_array, seed)
+
+
+class SlowIterator(IndexIterator):
+    """batches holding a slow sample take a while, the batches after them finish first"""
+    def __init__(self, n, batch_size, slow):
+        Iterator.__init__(self, n, batch_size, False, None)
+        self.slow = slow
+
+    def _process_batch_data(self, index_array, seed=None):
+        if np.isin(index_array, self.slow).any():
+            time.sleep(0.5)
+        return super()._process_batch_data(index_array, seed)
+
+
+class SeededIterator(IndexIterator):
+    """random values of a batch come from the batch's seed"""
+    def _process_batch_data(self, index_array, seed=None):
+        time.sleep(0.01)
+        return (np.random.RandomState(seed).rand(len(index_array)), np.asarray(index_array))
+
 
 class TestGenerator(unittest.TestCase):  
     def test_generator_queue(self):
@@ -31,8 +78,208 @@ class TestGenerator(unittest.TestCase):
             epoch += 1
         queue.stop()
 
+    def test_shared_memory_transport(self):
+        def generator():
+            for i in itertools.count():
+                yield (np.full((4, 16, 16), i, dtype=np.float64), np.ones((4, 16, 16), dtype=bool))
+
+        queue = GeneratorQueue(generator=generator(), transport='shm')
+        queue.start()
+        try:
+            output = queue.fetch()
+            for _ in range(30):
+                batch = next(output)
+                self.assertIsInstance(batch, SharedBatch)
+                x, y = batch
+                self.assertEqual(x.shape, (4, 16, 16))
+                self.assertTrue(y.all())
+                # zero-copy view into the slot
+                self.assertFalse(x.flags['OWNDATA'])
+        finally:
+            queue.stop()
+
+    def test_sharded_batches(self):
+        def load_epoch(max_workers):
+            config.Performance['max_workers'] = max_workers
+            queue = GeneratorQueue(generator=IndexIterator(100, 10, seed=7))
+            queue.start()
+            try:
+                output = queue.fetch()
+                return np.concatenate([next(output)[1] for _ in range(10)])
+            finally:
+                queue.stop()
+
+        max_workers = config.Performance['max_workers']
+        try:
+            single, multiple = load_epoch(1), load_epoch(4)
+        finally:
+            config.Performance['max_workers'] = max_workers
+        # every sample exactly once per epoch, same order for any number of workers
+        self.assertEqual(sorted(single.tolist()), list(range(100)))
+        self.assertTrue((single == multiple).all())
+
+    def test_fetch_many(self):
+        queue = GeneratorQueue(generator=IndexIterator(100, 10, seed=7))
+        queue.start()
+        try:
+            batches = queue.fetch_many(4) + queue.fetch_many(6)
+            self.assertEqual(len(batches), 10)
+            indices = np.concatenate([y for _, y in batches])
+            self.assertEqual(sorted(indices.tolist()), list(range(100)))
+            self.assertEqual(queue.stats()['fetched'], 10)
+        finally:
+            queue.stop()
+
+    def test_shm_fetch_many_out_of_order(self):
+        max_workers, cache_size = config.Performance['max_workers'], config.Performance['cache_size']
+        config.Performance['max_workers'], config.Performance['cache_size'] = 4, 4
+        try:
+            queue = GeneratorQueue(generator=SlowIterator(40, 5, slow=[5]), transport='shm')
+            queue.start()
+            try:
+                indices = []
+                for _ in range(4):
+                    # the batches held by this call keep their slots, later batches must not take the rest
+                    indices.extend(y.copy() for _, y in queue.fetch_many(2))
+            finally:
+                queue.stop()
+            self.assertEqual(np.concatenate(indices).tolist(), list(range(40)))
+
+            # double buffering, consumer releases a batch only after the next one arrived
+            queue = GeneratorQueue(generator=SlowIterator(40, 5, slow=[5]), transport='shm', auto_release=False)
+            queue.start()
+            try:
+                indices, previous = [], None
+                batches = queue.fetch()
+                for _ in range(8):
+                    batch = next(batches)
+                    indices.append(batch[1].copy())
+                    if previous is not None:
+                        previous.release()
+                    previous = batch
+            finally:
+                queue.stop()
+            self.assertEqual(np.concatenate(indices).tolist(), list(range(40)))
+        finally:
+            config.Performance['max_workers'], config.Performance['cache_size'] = max_workers, cache_size
+
+    def test_quarantine(self):
+        queue = GeneratorQueue(generator=BrokenIterator(100, 10, broken=[3, 42], seed=7))
+        queue.start()
+        try:
+            indices = np.concatenate([y for _, y in queue.fetch_many(10)])
+            # healthy samples of the failed batches are still delivered
+            self.assertEqual(sorted(set(indices.tolist())), sorted(set(range(100)) - {3, 42}))
+            self.assertEqual(queue.quarantined(), [3, 42])
+            self.assertIn('broken sample', queue.errors()[0]['traceback'])
+        finally:
+            queue.stop()
+
+    def test_everything_quarantined(self):
+        queue = GeneratorQueue(generator=BrokenIterator(20, 5, broken=list(range(20)), seed=7))
+        queue.start()
+        try:
+            # no sample can be loaded, fetch() fails instead of waiting forever
+            with self.assertRaises(RuntimeError):
+                list(queue.fetch())
+            self.assertEqual(queue.quarantined(), list(range(20)))
+        finally:
+            queue.stop()
+
+    def test_telemetry(self):
+        config.Performance['telemetry'] = True
+        queue = GeneratorQueue(generator=IndexIterator(100, 10, seed=7))
+        queue.start()
+        try:
+            queue.fetch_many(10)
+            stages = queue.telemetry()
+            self.assertGreater(stages['queue_get']['count'], 0)
+            self.assertIn('queue_depth', stages)
+            # recorded inside workers
+            self.assertIn('queue_put', stages)
+        finally:
+            queue.stop()
+            config.Performance['telemetry'] = False
+
+    def test_async_stream(self):
+        async def load():
+            async with AsyncBatchStream(IndexIterator(100, 10, seed=7), prefetch=3, steps=10) as stream:
+                return [y async for _, y in stream]
+
+        batches = asyncio.run(load())
+        self.assertEqual(len(batches), 10)
+        # same order as the iterator itself
+        iterator = IndexIterator(100, 10, seed=7)
+        for batch in batches:
+            self.assertTrue((batch == next(iterator.index_generator)).all())
+
+    def test_seeded_batches(self):
+        async def load():
+            async with AsyncBatchStream(SeededIterator(100, 10, seed=1), prefetch=4, steps=10) as stream:
+                return [x async for x, _ in stream]
+
+        iterator = SeededIterator(100, 10, seed=1)
+        expected = []
+        for _ in range(10):
+            index_array = next(iterator.index_generator)
+            expected.append(iterator._process_batch_data(index_array, iterator._batch_seed())[0])
+        loader = MapLoader(SeededIterator(100, 10, seed=1), max_workers=0)
+        # batches loaded in threads while the event loop seeds np.random for the next draws
+        for batches in [asyncio.run(load()) for _ in range(3)] + [[x for x, _ in loader]]:
+            self.assertEqual(len(batches), 10)
+            for a, b in zip(expected, batches):
+                self.assertTrue((a == b).all())
+
+    def test_epochs(self):
+        queue = GeneratorQueue(IndexIterator(95, 10, seed=2))
+        queue.start()
+        try:
+            epochs = [[y for _, y in queue.epoch()] for _ in range(3)]
+        finally:
+            queue.stop()
+        iterator = IndexIterator(95, 10, seed=2)
+        for epoch in epochs:
+            # one pass in the iterator's order, the short last batch doesn't spill into the next epoch
+            self.assertEqual(len(epoch), 10)
+            self.assertEqual(sorted(np.concatenate(epoch)), list(range(95)))
+            for batch in epoch:
+                self.assertTrue((batch == next(iterator.index_generator)).all())
+
+    def test_map_loader(self):
+        class RandomIterator(IndexIterator):
+            def _process_batch_data(self, index_array, seed=None):
+                return (np.random.rand(len(index_array)), np.asarray(index_array))
+
+        epochs = {}
+        for workers in (0, 1, 3):
+            loader = MapLoader(RandomIterator(95, 10, seed=3), max_workers=workers, prefetch=3)
+            try:
+                epochs[workers] = [[batch for batch in loader] for _ in range(2)]
+            finally:
+                loader.stop()
+        self.assertEqual(len(epochs[0][0]), 10)
+        self.assertEqual(sorted(np.concatenate([y for _, y in epochs[0][0]])), list(range(95)))
+        # bit-for-bit the same, whatever the number of workers
+        for workers in (1, 3):
+            for expected, epoch in zip(epochs[0], epochs[workers]):
+                for (a_x, a_y), (b_x, b_y) in zip(expected, epoch):
+                    self.assertTrue((a_x == b_x).all() and (a_y == b_y).all())
+
+    def test_finite_generator(self):
+        def generator():
+            for i in range(3):
+                yield (np.full(4, i), np.ones(4))
+
+        queue = GeneratorQueue(generator=generator())
+        queue.start()
+        try:
+            # every worker consumes its own copy, fetch ends once all of them finished
+            batches = list(queue.fetch())
+            self.assertEqual(len(batches), 3 * config.Performance['max_workers'])
+        finally:
+            queue.stop()
+
         
 
 if __name__ == '__main__':
     unittest.main()
-
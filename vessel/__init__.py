@@ -2,5 +2,10 @@ from . import preprocess
 from . import configuration
 from . import utils
 from . import parser
+from . import cache
+from . import telemetry
+from . import stream
+from . import augment
+from . import pack
 
-__version__ = '0.0.1'
\ No newline at end of file
+__version__ = '0.0.1'
@@ -0,0 +1,119 @@
+"""Batched augmentation of dense batches
+
+A transform is a callable (batch_x, batch_y, rng) -> (batch_x, batch_y):
+    batch_x: (B, H, W) pixel data
+    batch_y: (B, H, W) masks or label maps, or (B, C, H, W) mask channels
+    rng: np.random.RandomState of the batch
+Spatial transforms move image and masks together, intensity transforms only touch the image.
+Every transform works on the whole batch with numpy operations, random parameters are drawn per sample.
+"""
+
+import numpy as np
+
+
+def _float(batch_x):
+    """intensity transforms produce float32 unless the batch is floating already"""
+    if np.issubdtype(batch_x.dtype, np.floating):
+        return batch_x
+    return batch_x.astype(np.float32)
+
+
+class Compose(object):
+    """apply transforms in order
+       e.g. Compose([RandomCrop(128, 128), RandomFlip(), RandomRot90(), IntensityJitter(), WindowLevel(40, 400)])
+    """
+    def __init__(self, transforms):
+        self.transforms = list(transforms)
+
+    def __call__(self, batch_x, batch_y, rng):
+        for transform in self.transforms:
+            batch_x, batch_y = transform(batch_x, batch_y, rng)
+        return batch_x, batch_y
+
+
+class RandomCrop(object):
+    """crop a (height, width) window at a random position of every sample"""
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+
+    def __call__(self, batch_x, batch_y, rng):
+        n, height, width = batch_x.shape
+        if self.height > height or self.width > width:
+            raise ValueError("Can't crop ({}, {}) out of ({}, {})".format(self.height, self.width, height, width))
+        top = rng.randint(0, height - self.height + 1, size=n)
+        left = rng.randint(0, width - self.width + 1, size=n)
+        rows = (top[:, None] + np.arange(self.height))[:, :, None]         # (B, h, 1)
+        cols = (left[:, None] + np.arange(self.width))[:, None, :]         # (B, 1, w)
+        samples = np.arange(n)[:, None, None]
+
+        batch_x = batch_x[samples, rows, cols]
+        if batch_y.ndim == 4:
+            # mask channels share the window of their sample
+            batch_y = batch_y[samples[:, None], np.arange(batch_y.shape[1])[None, :, None, None],
+                              rows[:, None], cols[:, None]]
+        else:
+            batch_y = batch_y[samples, rows, cols]
+        return batch_x, batch_y
+
+
+class RandomFlip(object):
+    """flip samples left-right and/or up-down, each with probability p"""
+    def __init__(self, horizontal=True, vertical=True, p=0.5):
+        self.axes = [axis for axis, enabled in ((-1, horizontal), (-2, vertical)) if enabled]
+        self.p = p
+
+    def __call__(self, batch_x, batch_y, rng):
+        batch_x, batch_y = batch_x.copy(), batch_y.copy()
+        for axis in self.axes:
+            flip = rng.rand(len(batch_x)) < self.p
+            batch_x[flip] = np.flip(batch_x[flip], axis)
+            batch_y[flip] = np.flip(batch_y[flip], axis)
+        return batch_x, batch_y
+
+
+class RandomRot90(object):
+    """rotate samples by a random multiple of 90 degrees
+       quarter turns swap height and width, they are only drawn if slices are square
+    """
+    def __call__(self, batch_x, batch_y, rng):
+        n, height, width = batch_x.shape
+        step = 1 if height == width else 2
+        turns = rng.randint(0, 4 // step, size=n) * step
+        batch_x, batch_y = batch_x.copy(), batch_y.copy()
+        for k in np.unique(turns):
+            if k == 0:
+                continue
+            rotate = turns == k
+            batch_x[rotate] = np.rot90(batch_x[rotate], k, axes=(-2, -1))
+            batch_y[rotate] = np.rot90(batch_y[rotate], k, axes=(-2, -1))
+        return batch_x, batch_y
+
+
+class IntensityJitter(object):
+    """x * gain + offset * std(x), gain in [1 - scale, 1 + scale], offset in [-shift, shift] per sample"""
+    def __init__(self, scale=0.1, shift=0.1):
+        self.scale = scale
+        self.shift = shift
+
+    def __call__(self, batch_x, batch_y, rng):
+        batch_x = _float(batch_x)
+        n = len(batch_x)
+        gain = rng.uniform(1 - self.scale, 1 + self.scale, size=n).astype(batch_x.dtype)
+        offset = rng.uniform(-self.shift, self.shift, size=n).astype(batch_x.dtype)
+        std = batch_x.reshape(n, -1).std(axis=1)
+        return batch_x * gain[:, None, None] + (offset * std)[:, None, None], batch_y
+
+
+class WindowLevel(object):
+    """map the window [center - width / 2, center + width / 2] to [0, 1], values outside are clipped
+       e.g. WindowLevel(40, 400) for a soft tissue window of CT slices in Hounsfield units
+    """
+    def __init__(self, center, width):
+        self.center = center
+        self.width = width
+
+    def __call__(self, batch_x, batch_y, rng):
+        batch_x = _float(batch_x)
+        low = self.center - self.width / 2.0
+        return np.clip((batch_x - low) / self.width, 0, 1).astype(batch_x.dtype, copy=False), batch_y
@@ -0,0 +1,178 @@
+"""Caches of decoded DICOM slices and masks"""
+
+import os
+import json
+import numpy as np
+
+from vessel.parser import DICOMParser
+from vessel.pack import DatasetPack
+from vessel.utils import temp_name, dump_json
+
+
+def _mtime(filename):
+    """modification time of a file, None means no file"""
+    if not filename:
+        return None
+    return DatasetPack.getmtime(filename)
+
+
+class SliceCache(object):
+    """Persistent on-disk cache of decoded slices
+    The decode cost (DICOM read, rescale, contour rasterization) is paid once by `build`,
+    afterwards batches are read by fancy-indexing memory-mapped arrays.
+    The cache directory contains:
+       pixels.npy   # (N, H, W) rescaled pixel data, slices smaller than (H, W) are zero padded
+       masks.npy    # (N, H, ceil(W / 8)) masks, bit-packed along the last axis
+                    #   or (N, 2, H, ceil(W / 8)) if i-contour and o-contour masks are both cached
+       index.json   # DICOM path -> row, with mtimes of DICOM/contour files and original size, format version
+    """
+    PIXELS_FILE = 'pixels.npy'
+    MASKS_FILE = 'masks.npy'
+    INDEX_FILE = 'index.json'
+    VERSION = 1                 # layout of index.json, caches of another version are rejected
+
+    def __init__(self, directory):
+        """Open an existing cache
+        :param directory: folder written by SliceCache.build
+        """
+        self._directory = os.path.abspath(directory)
+        index_file = os.path.join(self._directory, self.INDEX_FILE)
+        if not os.path.exists(index_file):
+            raise IOError("Slice cache [{}] not exist!".format(self._directory))
+
+        with open(index_file, 'r') as fp_index:
+            index = json.load(fp_index)
+        if index.get('version') != self.VERSION:
+            raise IOError("Slice cache [{}] was built by another version, build it again".format(self._directory))
+        # entry: [dicom_file, dicom_mtime, i_contour_file, i_contour_mtime, height, width,
+        #         o_contour_file, o_contour_mtime]
+        self._entries = index['entries']
+        self.masks = index.get('masks', 'i')
+        self._rows = {entry[0]: row for row, entry in enumerate(self._entries)}
+        self._pixels = np.load(os.path.join(self._directory, self.PIXELS_FILE), mmap_mode='r')
+        self._masks = np.load(os.path.join(self._directory, self.MASKS_FILE), mmap_mode='r')
+
+    @staticmethod
+    def build(files, directory, dtype=np.float32, masks='i'):
+        """Decode every file group once and write the cache
+        :param files: numpy array of file groups, e.g. FileFeeder.files()
+        :param directory: output folder
+        :param dtype: dtype of the stored pixel data
+        :param masks: 'i', 'o' or 'io', which contour masks to cache, see DICOMParser.ReadDICOM
+        :return: the opened SliceCache
+        """
+        if masks not in ('i', 'o', 'io'):
+            raise ValueError("Unknown masks [{}]".format(masks))
+        directory = os.path.abspath(directory)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # read headers first, the memmap needs the largest slice size
+        groups = []
+        for dicom_file, i_contour_file, o_contour_file in files:
+            header = DICOMParser.Header(dicom_file)
+            if header:
+                groups.append((dicom_file, i_contour_file, o_contour_file, header['height'], header['width']))
+        height = max([group[3] for group in groups] or [0])
+        width = max([group[4] for group in groups] or [0])
+        channels = (len(masks), ) if len(masks) > 1 else ()
+
+        pixels_file = os.path.join(directory, SliceCache.PIXELS_FILE)
+        masks_file = os.path.join(directory, SliceCache.MASKS_FILE)
+        index_file = os.path.join(directory, SliceCache.INDEX_FILE)
+        # arrays are written under temporary names, a cache already in directory (and the memmaps
+        # of its readers) stays intact until the new arrays are complete
+        temp_pixels, temp_masks = temp_name(pixels_file), temp_name(masks_file)
+        try:
+            pixels = np.lib.format.open_memmap(
+                temp_pixels, mode='w+', dtype=dtype, shape=(len(groups), height, width))
+            mask_memmap = np.lib.format.open_memmap(
+                temp_masks, mode='w+',
+                dtype=np.uint8, shape=(len(groups), ) + channels + (height, (width + 7) // 8))
+
+            entries = []
+            for row, (dicom_file, i_contour_file, o_contour_file, h, w) in enumerate(groups):
+                img, mask = DICOMParser.ReadDICOM(dicom_file, i_contour_file, o_contour_file, masks=masks)
+                pixels[row, :h, :w] = img
+                if mask is not None:
+                    packed = np.packbits(mask, axis=-1)
+                    mask_memmap[row, ..., :h, :packed.shape[-1]] = packed
+                entries.append([
+                    dicom_file, _mtime(dicom_file),
+                    i_contour_file, _mtime(i_contour_file),
+                    h, w,
+                    o_contour_file, _mtime(o_contour_file)
+                ])
+            pixels.flush()
+            mask_memmap.flush()
+            del pixels, mask_memmap
+
+            # the old index goes first, arrays and index of two builds are never opened together
+            if os.path.exists(index_file):
+                os.remove(index_file)
+            os.replace(temp_pixels, pixels_file)
+            os.replace(temp_masks, masks_file)
+        finally:
+            for temp_file in (temp_pixels, temp_masks):
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+
+        # index is written last, a half built cache can't be opened
+        dump_json(index_file, {'version': SliceCache.VERSION, 'entries': entries, 'masks': masks})
+
+        return SliceCache(directory)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def rows(self, files):
+        """Look up the cache rows of file groups
+        :param files: numpy array of file groups
+        :return: int array, -1 if a group isn't cached or its files changed since build
+        """
+        rows = np.full(len(files), -1, dtype=np.int64)
+        for i, (dicom_file, i_contour_file, o_contour_file) in enumerate(files):
+            row = self._rows.get(dicom_file)
+            if row is None:
+                continue
+            entry = self._entries[row]
+            # only the contours whose masks are cached matter
+            checks = [(dicom_file, entry[0], entry[1])]
+            if 'i' in self.masks:
+                checks.append((i_contour_file, entry[2], entry[3]))
+            if 'o' in self.masks:
+                checks.append((o_contour_file, entry[6], entry[7]))
+            try:
+                if all(filename == cached_file and _mtime(filename) == cached_mtime
+                       for filename, cached_file, cached_mtime in checks):
+                    rows[i] = row
+            except OSError:
+                continue
+        return rows
+
+    def read(self, rows, packed=False):
+        """Read slices from cache
+        :param rows: rows returned by SliceCache.rows
+        :param packed: if True masks are returned bit-packed along the last axis, uint8 (h, ceil(w / 8))
+        :return: list of (pixel_data, mask), mask is None if that slice has none of the cached contours
+            mask is (h, w), or (2, h, w) if masks is 'io'
+        """
+        rows = np.asarray(rows)
+        # sorted reads are sequential on disk
+        order = np.argsort(rows, kind='stable')
+        sorted_rows = rows[order]
+        pixels = self._pixels[sorted_rows]
+        masks = self._masks[sorted_rows]
+
+        samples = [None] * len(rows)
+        for pos, i in enumerate(order):
+            entry = self._entries[sorted_rows[pos]]
+            h, w = entry[4], entry[5]
+            contours = {'i': entry[2], 'o': entry[6]}
+            mask = None
+            if any(contours[channel] for channel in self.masks):
+                mask = masks[pos, ..., :h, :(w + 7) // 8]
+                if not packed:
+                    mask = np.unpackbits(mask, axis=-1, count=w).astype(bool)
+            samples[i] = (pixels[pos, :h, :w], mask)
+        return samples
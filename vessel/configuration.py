@@ -3,9 +3,22 @@ IOConfig = {
     'dicoms_folder': 'dicoms',
     'contour_folder': 'contourfiles',
     'inner_contour_folder': 'i-contours',
-    'outter_contour_folder': 'o-contours'
+    'outter_contour_folder': 'o-contours',
+    'metadata_file': 'metadata.json',   # header index of every DICOM, written into the data directory
+    'scan_manifest': 'scan_manifest.json',  # result of FileFeeder.scan_files, written into the data directory
+    'pack_shard_bytes': 1 << 30             # size of a shard file of PackedFileFeeder.pack
 }
 Performance = {
     'max_workers': 4,       # how many workers
-    'cache_size': 20        # how many batches hold inside the queue
+    'cache_size': 20,       # how many batches hold inside the queue
+    'transport': 'queue',   # 'queue': pickle batches through mp.Queue, 'shm': shared memory slots
+    'shm_slot_size': 16 << 20,  # bytes of one shared memory slot, must hold a whole batch
+    'parser_cache_bytes': 0,    # byte budget of DICOMParser's in-process LRU cache, 0: disabled
+    'scan_workers': 8,          # threads scanning patient folders in FileFeeder.scan_files
+    'decode_threads': 0,        # threads decoding the samples of one batch (in every worker), 0: sequential
+    'volume_cache_bytes': 512 << 20,    # byte budget of VolumeIterator's decoded slices (in every worker), 0: disabled
+    'max_retries': 3,           # restarts of a dead worker / consecutive errors of a generator before giving up
+    'telemetry': False,         # record per-stage timings, see vessel.telemetry
+    'telemetry_log': None,      # file GeneratorQueue appends telemetry json lines to, None: no log
+    'telemetry_interval': 10    # seconds between two telemetry log lines
 }
\ No newline at end of file
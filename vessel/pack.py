@@ -0,0 +1,207 @@
+"""Dataset pack: the DICOM and contour files of a dataset in a few large shard files with an offset index
+
+A pack directory contains:
+   shard-00000.bin  # raw DICOM bytes and contour coordinates (float64 (N, 2)) one after another
+   ...
+   index.json       # name -> [shard, offset, length, kind], plus whatever the writer adds (e.g. file groups)
+Entries are read by offset from memory-mapped shards, a sample costs no open/read/close.
+Shards and index are written under temporary names and replace the files of an older pack in the same
+directory when the writer is closed, readers which mapped the old shards keep reading them.
+A packed file is addressed by a virtual path 'pack:<pack directory>::<name>' which DICOMParser accepts
+wherever it takes a file path.
+"""
+
+import io
+import os
+import json
+import mmap
+import threading
+
+import numpy as np
+
+from vessel.utils import temp_name, dump_json
+
+
+PREFIX = 'pack:'
+SEPARATOR = '::'
+
+
+class PackWriter(object):
+    """Append files to the shards of a new pack
+       e.g.
+          writer = PackWriter('data_pack')
+          writer.add_bytes('dicoms/SCD0000101/1.dcm', raw_bytes)
+          writer.add_array('contourfiles/SC-HF-I-1/i-contours/IM-0001-0048-icontour-manual.txt', coords)
+          writer.close({'patients': ...})
+    """
+    SHARD_NAME = 'shard-{:05d}.bin'
+
+    def __init__(self, directory, shard_bytes):
+        """
+        shard_bytes: a new shard is started once a shard holds more than shard_bytes
+        """
+        self.directory = directory
+        self.shard_bytes = shard_bytes
+        self._shards = []
+        self._entries = {}
+        self._fp = None
+        self._offset = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _shard(self, nbytes):
+        if self._fp is None or (self._offset > 0 and self._offset + nbytes > self.shard_bytes):
+            if self._fp is not None:
+                self._fp.close()
+            self._shards.append(self.SHARD_NAME.format(len(self._shards)))
+            self._fp = open(temp_name(os.path.join(self.directory, self._shards[-1])), 'wb')
+            self._offset = 0
+        return len(self._shards) - 1
+
+    def _add(self, name, data, kind):
+        shard = self._shard(len(data))
+        # entries start at 8 bytes boundaries, arrays can be viewed in place
+        padding = -self._offset % 8
+        self._fp.write(b'\0' * padding)
+        self._offset += padding
+        self._entries[name] = [shard, self._offset, len(data), kind]
+        self._fp.write(data)
+        self._offset += len(data)
+
+    def add_bytes(self, name, data):
+        self._add(name, data, 'bytes')
+
+    def add_array(self, name, array):
+        self._add(name, np.ascontiguousarray(array, dtype=np.float64).tobytes(), 'coords')
+
+    def close(self, extra=None):
+        """move the shards in place and write index.json, extra: more items of the index"""
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        index_file = os.path.join(self.directory, DatasetPack.INDEX_FILE)
+        # the old index goes first, shards and index of two packs are never opened together
+        if os.path.exists(index_file):
+            os.remove(index_file)
+        for name in os.listdir(self.directory):
+            if name.startswith('shard-') and name.endswith('.bin') and name not in self._shards:
+                os.remove(os.path.join(self.directory, name))
+        for name in self._shards:
+            filename = os.path.join(self.directory, name)
+            os.replace(temp_name(filename), filename)
+        dump_json(index_file, dict(extra or {}, shards=self._shards, entries=self._entries))
+
+    def discard(self):
+        """drop what was written so far, a pack already in directory stays as it was"""
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        for name in self._shards:
+            temp_file = temp_name(os.path.join(self.directory, name))
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+
+class DatasetPack(object):
+    """Reader of a pack written by PackWriter
+       Shards are memory-mapped lazily, readers of every thread share them.
+    """
+    INDEX_FILE = 'index.json'
+    _packs = {}                 # opened packs of this process, keyed by directory
+    _locker = threading.Lock()
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        index_file = os.path.join(self.directory, self.INDEX_FILE)
+        with open(index_file, 'r') as fp_index:
+            stat = os.fstat(fp_index.fileno())
+            self.index = json.load(fp_index)
+        self.mtime = stat.st_mtime
+        self.stamp = (stat.st_mtime_ns, stat.st_ino)     # a new index.json is a new pack
+        self._maps = [None] * len(self.index['shards'])
+
+    @staticmethod
+    def open(directory):
+        """the DatasetPack of directory, opened once per process and again once the directory is re-packed"""
+        directory = os.path.abspath(directory)
+        with DatasetPack._locker:
+            pack = DatasetPack._packs.get(directory)
+            if pack is not None:
+                try:
+                    stat = os.stat(os.path.join(directory, DatasetPack.INDEX_FILE))
+                    stale = (stat.st_mtime_ns, stat.st_ino) != pack.stamp
+                except OSError:
+                    stale = True
+                if stale:
+                    del DatasetPack._packs[directory]
+                    pack.close()
+                    pack = None
+            if pack is None:
+                pack = DatasetPack._packs[directory] = DatasetPack(directory)
+            return pack
+
+    @staticmethod
+    def evict(directory):
+        """forget and close the opened DatasetPack of directory, e.g. before writing a new pack into it"""
+        with DatasetPack._locker:
+            pack = DatasetPack._packs.pop(os.path.abspath(directory), None)
+        if pack is not None:
+            pack.close()
+
+    def close(self):
+        """unmap the shards, a shard still viewed by some array stays mapped until the array is gone"""
+        for shard, mapped in enumerate(self._maps):
+            if mapped is None:
+                continue
+            try:
+                mapped.close()
+            except BufferError:
+                pass
+            self._maps[shard] = None
+
+    def path(self, name):
+        """virtual path of a packed file"""
+        return PREFIX + self.directory + SEPARATOR + name
+
+    @staticmethod
+    def is_packed(path):
+        return isinstance(path, str) and path.startswith(PREFIX)
+
+    @staticmethod
+    def resolve(path):
+        """
+        :return: (DatasetPack, name) of a virtual path
+        """
+        directory, name = path[len(PREFIX):].split(SEPARATOR, 1)
+        return DatasetPack.open(directory), name
+
+    def _map(self, shard):
+        if self._maps[shard] is None:
+            with DatasetPack._locker:
+                if self._maps[shard] is None:
+                    with open(os.path.join(self.directory, self.index['shards'][shard]), 'rb') as fp_shard:
+                        self._maps[shard] = mmap.mmap(fp_shard.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[shard]
+
+    def buffer(self, name):
+        """read-only memoryview of a packed file, no copy"""
+        shard, offset, length, _ = self.index['entries'][name]
+        return memoryview(self._map(shard))[offset:offset + length]
+
+    def coords(self, name):
+        """float array (N, 2) of a packed contour, a read-only view of the shard"""
+        return np.frombuffer(self.buffer(name), dtype=np.float64).reshape(-1, 2)
+
+    @staticmethod
+    def source(path):
+        """what to open for path: the path itself, or a file-like object over a packed file"""
+        if not DatasetPack.is_packed(path):
+            return path
+        pack, name = DatasetPack.resolve(path)
+        return io.BytesIO(pack.buffer(name))
+
+    @staticmethod
+    def getmtime(path):
+        """modification time of a file, the pack's for a packed file"""
+        if DatasetPack.is_packed(path):
+            return DatasetPack.resolve(path)[0].mtime
+        return os.path.getmtime(path)
@@ -1,78 +1,312 @@
 """Parsing code for DICOMS and contour files"""
 
+import re
 import dicom
 from dicom.errors import InvalidDicomError
 
 import numpy as np
 from PIL import Image, ImageDraw
 
+import vessel.configuration as config
+from vessel.utils import LRUCache
+from vessel.pack import DatasetPack
+from vessel.telemetry import telemetry
+
+
+# a well-formed contour text, every line is blank or "x y" or "x,y"
+_COORDS_LINE = r'[ \t]*(?:[-+.0-9eE]+[ ,][-+.0-9eE]+[ \t]*)?'
+_COORDS_TEXT = re.compile(r'(?:{0}\n)*{0}'.format(_COORDS_LINE).encode())
+
+
+def _draw(coords, mask):
+    """Fill a polygon into mask in place, PIL ImageDraw.polygon(xy, fill=1, outline=0) on a 'L' image
+    :param coords: float array (N, 2), a polygon with less than 2 vertices is skipped
+    :param mask: C-contiguous bool array (height, width) filled with False
+    """
+    if len(coords) < 2:
+        return
+    height, width = mask.shape
+    img = Image.frombuffer('L', (width, height), mask.view(np.uint8), 'raw', 'L', 0, 1)
+    # the image maps the memory of mask, PIL marks it read-only and would draw into a copy
+    img.readonly = 0
+    ImageDraw.Draw(img).polygon(xy=np.asarray(coords, dtype=np.float64).ravel().tolist(), outline=0, fill=1)
+
 
 class DICOMParser():
+    _lru = None
+
+    @staticmethod
+    def cache():
+        """In-process LRU cache of Pixel and CreateMask results
+        keyed by file path and mtime, bounded by config.Performance['parser_cache_bytes']
+        Cached arrays are read-only since they are shared by every caller.
+        :return: the LRUCache, None if caching is disabled
+        """
+        max_bytes = config.Performance['parser_cache_bytes']
+        if not max_bytes:
+            return None
+        if DICOMParser._lru is None:
+            DICOMParser._lru = LRUCache(max_bytes)
+        elif DICOMParser._lru.max_bytes != max_bytes:
+            DICOMParser._lru.resize(max_bytes)
+        return DICOMParser._lru
+
     @staticmethod
     def Pixel(filename):
         """Parse the given DICOM filename
-        :param filename: filepath to the DICOM file to parse
+        :param filename: filepath to the DICOM file to parse, or a packed file (see vessel.pack)
         :return: dictionary with DICOM image data
         """
+        cache = DICOMParser.cache()
+        if cache is not None:
+            key = ('pixel', filename, DatasetPack.getmtime(filename))
+            result = cache.get(key)
+            if result is not None:
+                return result
+
+        with telemetry.timer('pixel_read'):
+            try:
+                dcm = dicom.read_file(DatasetPack.source(filename))
+            except InvalidDicomError as e:
+                print(e)
+                return None
+
+            dcm_image = dcm.pixel_array
+
+        if hasattr(dcm, 'RescaleIntercept') and hasattr(dcm, 'RescaleSlope'):
+            with telemetry.timer('rescale'):
+                dcm_image = dcm_image * dcm.RescaleSlope + dcm.RescaleIntercept
+
+        result = { 'pixel_data' : dcm_image, 'width': dcm.Columns, 'height': dcm.Rows }
+        if cache is not None:
+            dcm_image.flags.writeable = False
+            cache.put(key, result, dcm_image.nbytes)
+        return result
+
+    @staticmethod
+    def Header(filename):
+        """Parse the header of given DICOM filename, pixel data is not read
+        :param filename: filepath to the DICOM file to parse
+        :return: dictionary with DICOM header data, missing attributes are None
+        """
         try:
-            dcm = dicom.read_file(filename)
+            dcm = dicom.read_file(DatasetPack.source(filename), stop_before_pixels=True)
         except InvalidDicomError as e:
             print(e)
             return None
 
-        dcm_image = dcm.pixel_array
+        slope = getattr(dcm, 'RescaleSlope', None)
+        intercept = getattr(dcm, 'RescaleIntercept', None)
+        instance_number = getattr(dcm, 'InstanceNumber', None)
+        patient_id = getattr(dcm, 'PatientID', None)
+        return {
+            'width': int(dcm.Columns),
+            'height': int(dcm.Rows),
+            'rescale_slope': None if slope is None else float(slope),
+            'rescale_intercept': None if intercept is None else float(intercept),
+            'patient_id': None if patient_id is None else str(patient_id),
+            'instance_number': None if instance_number in (None, '') else int(instance_number)
+        }
 
-        if hasattr(dcm, 'RescaleIntercept') and hasattr(dcm, 'RescaleSlope'):
-            dcm_image = dcm_image * dcm.RescaleSlope + dcm.RescaleIntercept
+    @staticmethod
+    def _CoordsByLine(text):
+        """Parse contour text line by line, lines which can't be parsed are ignored
+        :return: list of tuples holding x, y coordinates of the contour
+        """
+        coords_lst = []
+        for line in text.split('\n'):
+            line = line.strip()
+            if not line:
+                continue
+
+            coords = line.split(' ')
+            if len(coords) != 2:
+                # try to split with ,
+                coords = line.split(',')
+                if len(coords) != 2:
+                    continue
+
+            try:
+                coor_x, coor_y = float(coords[0]), float(coords[1])
+            except ValueError:
+                continue
+
+            coords_lst.append(( coor_x, coor_y ))
+        return coords_lst
+
+    @staticmethod
+    def _CoordsTokens(data):
+        """Bulk split the bytes of a contour file, every line must be blank or a well-formed "x y" / "x,y"
+        :return: list of coordinate bytes x1, y1, x2, y2..., None if any line is malformed
+        """
+        if _COORDS_TEXT.fullmatch(data) is None:
+            return None
+        return data.replace(b',', b' ').split()
+
+    @staticmethod
+    def _ParseCoords(filename):
+        """Coords without telemetry, see Coords"""
+        if DatasetPack.is_packed(filename):
+            pack, name = DatasetPack.resolve(filename)
+            return pack.coords(name)
 
-        return { 'pixel_data' : dcm_image, 'width': dcm.Columns, 'height': dcm.Rows }
+        with open(filename, 'rb') as infile:
+            data = infile.read()
+        tokens = DICOMParser._CoordsTokens(data)
+        if tokens is not None:
+            try:
+                return np.array(tokens, dtype=np.float64).reshape(-1, 2)
+            except ValueError:
+                # a token is not a valid float
+                pass
+        return np.array(DICOMParser._CoordsByLine(data.decode()), dtype=np.float64).reshape(-1, 2)
 
     @staticmethod
     def Coords(filename):
         """Parse the given contour filename
+        Well-formed files are split and converted to floats in one pass, files with malformed lines
+        fall back to the line by line parser which ignores those lines.
 
-        :param filename: filepath to the contourfile to parse
-        :return: list of tuples holding x, y coordinates of the contour
+        :param filename: filepath to the contourfile to parse, a packed contour is read as it is
+        :return: float array (N, 2) holding x, y coordinates of the contour
         """
+        with telemetry.timer('coords_parse'):
+            return DICOMParser._ParseCoords(filename)
 
-        coords_lst = []
-        with open(filename, 'r') as infile:
-            for line in infile:
-                line = line.strip()
-                if not line:
-                    continue
+    @staticmethod
+    def CoordsBatch(filenames):
+        """Parse many contour files in one call, see Coords
 
-                coords = line.split(' ')
-                if len(coords) != 2:
-                    # try to split with ,
-                    coords = line.split(',')
-                    if len(coords) != 2:
-                        continue
-                
-                try:
-                    coor_x, coor_y = float(coords[0]), float(coords[1])
-                except ValueError:
-                    continue
+        :param filenames: filepaths to the contourfiles to parse
+        :return: list of float array (N, 2), one for each contour file
+        """
+        with telemetry.timer('coords_parse'):
+            return [DICOMParser._ParseCoords(filename) for filename in filenames]
 
-                coords_lst.append(( coor_x, coor_y ))
-        return coords_lst
+    @staticmethod
+    def Rasterize(coords, width, height, out=None):
+        """Fill a polygon into a mask, PIL draws it straight into the buffer
+        a polygon with less than 2 vertices gives an empty mask instead of an error
+
+        :param coords: float array (N, 2) holding x, y coordinates of the polygon
+        :param out: optional buffer to write into, bool array (height, width)
+            or uint8 array (height, ceil(width / 8)) for a mask bit-packed along the last axis
+        :return: the mask
+        """
+        if out is not None:
+            out = out[np.newaxis]
+        return DICOMParser.RasterizeBatch([coords], width, height, out)[0]
+
+    @staticmethod
+    def RasterizeBatch(coords_lst, width, height, out=None):
+        """Fill many polygons of the same image size in one pass
+
+        :param coords_lst: list of float array (N, 2), one polygon for each mask
+        :param out: optional buffer to write into, bool array (B, height, width)
+            or uint8 array (B, height, ceil(width / 8)) for masks bit-packed along the last axis
+        :return: the masks (B, height, width)
+        """
+        shape = (len(coords_lst), height, width)
+        if out is None:
+            out = mask = np.zeros(shape, dtype=bool)
+        elif out.dtype == bool and out.flags.c_contiguous:
+            mask = out
+            mask[...] = False
+        else:
+            mask = np.zeros(shape, dtype=bool)
+
+        for coords, slice_mask in zip(coords_lst, mask):
+            _draw(coords, slice_mask)
+
+        if mask is not out:
+            out[...] = mask if out.dtype == bool else np.packbits(mask, axis=-1)
+        return out
 
     @staticmethod
     def CreateMask(contour_file, width, height):
-        ploy = DICOMParser.Coords(contour_file)
-        img = Image.new(mode='L', size=(width, height), color=0)
-        ImageDraw.Draw(img).polygon(xy=ploy, outline=0, fill=1)
-        mask = np.array(img).astype(bool)
+        cache = DICOMParser.cache()
+        if cache is not None:
+            key = ('mask', contour_file, DatasetPack.getmtime(contour_file), width, height)
+            mask = cache.get(key)
+            if mask is not None:
+                return mask
+
+        with telemetry.timer('create_mask'):
+            ploy = DICOMParser.Coords(contour_file)
+            mask = DICOMParser.Rasterize(ploy, width, height)
+        if cache is not None:
+            mask.flags.writeable = False
+            cache.put(key, mask, mask.nbytes)
         return mask
 
     @staticmethod
-    def ReadDICOM(dicom_file, i_contour_file=None, o_contour_file=None):
+    def CreateMasks(contour_files, width, height, out=None):
+        """Rasterize the contours of one slice in one pass into a single buffer
+        :param contour_files: list of contour files, None for a missing contour
+        :param out: optional bool array (len(contour_files), height, width) to write into
+        :return: bool array (len(contour_files), height, width), all False for a missing contour
+        """
+        if out is None:
+            out = np.zeros((len(contour_files), height, width), dtype=bool)
+        present = [i for i, contour_file in enumerate(contour_files) if contour_file]
+        missing = [i for i, contour_file in enumerate(contour_files) if not contour_file]
+        out[missing] = False
+
+        if DICOMParser.cache() is not None:
+            # masks of every contour file are cached on their own
+            for i in present:
+                out[i] = DICOMParser.CreateMask(contour_files[i], width, height)
+            return out
+
+        with telemetry.timer('create_mask'):
+            coords_lst = DICOMParser.CoordsBatch([contour_files[i] for i in present])
+            if not missing:
+                DICOMParser.RasterizeBatch(coords_lst, width, height, out=out)
+            elif present:
+                out[present] = DICOMParser.RasterizeBatch(coords_lst, width, height)
+        return out
+
+    @staticmethod
+    def LabelMap(masks):
+        """Merge i/o-contour masks into one label map
+        :param masks: bool array (2, height, width), i-contour and o-contour masks
+        :return: uint8 array (height, width), 0: background, 1: inside o-contour, 2: inside i-contour
+        """
+        label = masks[1].astype(np.uint8)
+        label[masks[0]] = 2
+        return label
+
+    # masks which ReadDICOM can return
+    MASKS = ('i', 'o', 'io', 'label')
+
+    @staticmethod
+    def ReadDICOM(dicom_file, i_contour_file=None, o_contour_file=None, masks='i'):
+        """
+        :param masks: which masks to rasterize, the DICOM is decoded once whatever is asked
+            'i': i-contour mask (height, width)
+            'o': o-contour mask (height, width)
+            'io': bool array (2, height, width), i-contour and o-contour masks, all False for a missing contour
+            'label': uint8 label map (height, width), see LabelMap
+        :return: (pixel_data, mask), mask is None if none of the asked contours exists
+        """
+        if masks not in DICOMParser.MASKS:
+            raise ValueError("Unknown masks [{}]".format(masks))
+
         dcm = DICOMParser.Pixel(dicom_file)
         if not dcm:
             return None
 
-        mask = None
-        if i_contour_file:
-            mask = DICOMParser.CreateMask(i_contour_file, dcm['width'], dcm['height'])
-            
-        return (dcm['pixel_data'], mask)
\ No newline at end of file
+        contours = {'i': i_contour_file, 'o': o_contour_file}
+        if masks in ('i', 'o'):
+            mask = None
+            if contours[masks]:
+                mask = DICOMParser.CreateMask(contours[masks], dcm['width'], dcm['height'])
+            return (dcm['pixel_data'], mask)
+
+        contour_files = [i_contour_file, o_contour_file]
+        if not any(contour_files):
+            return (dcm['pixel_data'], None)
+        stack = DICOMParser.CreateMasks(contour_files, dcm['width'], dcm['height'])
+        if masks == 'label':
+            return (dcm['pixel_data'], DICOMParser.LabelMap(stack))
+        return (dcm['pixel_data'], stack)
@@ -1,10 +1,15 @@
 import re
 import os
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import vessel.configuration as config
 from vessel.parser import DICOMParser
-from vessel.utils import Iterator
+from vessel.cache import SliceCache
+from vessel.pack import DatasetPack, PackWriter
+from vessel.utils import Iterator, LRUCache, load_json, dump_json
+from vessel.telemetry import telemetry
 
 
 class PatientFile(object):
@@ -13,26 +18,60 @@ class PatientFile(object):
     """
     FILE_SETS_LABELS = ['dicoms', 'i_contours', 'o_contours']
 
-    def __init__(self, dicoms_folder, contour_folder):
+    def __init__(self, dicoms_folder, contour_folder, manifest=None):
+        """
+        manifest: a dict returned by PatientFile.manifest(), if given the folders aren't scanned again
+        """
+        if manifest is not None:
+            self._files = manifest['files']
+            self._paths = manifest['paths']
+            self._paired_files = manifest['paired_files']
+            return
+
         self._paired_files = []
         self._files = {}
         self._paths = {}
-        path_to_be_scanned = [
+        # scan file in specific directory
+        for label, path in zip(self.FILE_SETS_LABELS, self.folders(dicoms_folder, contour_folder)):
+            self._paths[label] = path
+            self._files[label] = self._list_files(path)
+
+        self._build_file_array()
+
+    @staticmethod
+    def folders(dicoms_folder, contour_folder):
+        """folders of dicoms, i-contours and o-contours"""
+        return [
             dicoms_folder,
             os.path.join(contour_folder, config.IOConfig['inner_contour_folder']),
             os.path.join(contour_folder, config.IOConfig['outter_contour_folder'])
         ]
-        
-        # scan file in specific directory
-        for i, path in enumerate(path_to_be_scanned):
-            files = []
-            for dirname, _, filenames in os.walk(path):
-                self._paths[self.FILE_SETS_LABELS[i]] = path
-                for filename in filenames:
-                    files.append(filename)
-            self._files[self.FILE_SETS_LABELS[i]] = files
 
-        self._build_file_array()
+    @staticmethod
+    def folder_mtimes(dicoms_folder, contour_folder):
+        """mtimes(ns) of the scanned folders, None if a folder doesn't exist
+           a folder's mtime changes when a file is added, removed or renamed in it
+        """
+        mtimes = []
+        for path in PatientFile.folders(dicoms_folder, contour_folder):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    @staticmethod
+    def _list_files(path):
+        """names of the files in path, [] if path doesn't exist"""
+        try:
+            with os.scandir(path) as entries:
+                return [entry.name for entry in entries if entry.is_file()]
+        except OSError:
+            return []
+
+    def manifest(self):
+        """scan result which can be persisted as json and passed back to PatientFile"""
+        return {'files': self._files, 'paths': self._paths, 'paired_files': self._paired_files}
 
     def _build_file_array(self):
         """
@@ -114,6 +153,7 @@ class FileFeeder(object):
         self._patient_contours = {}         # a map describe dicoms(patient id) and contourfiles
         self._patient_files = {}            # a map decribe patient id ant PatientFile object
         self._file_array = None
+        self._metadata = None
         self.n = 0
         self._iter_index = 0
         if os.path.exists(self._directory):
@@ -139,6 +179,8 @@ class FileFeeder(object):
            2. for each [patient]
               build link between  [*.dcm] <---> ([i-contour], [o-contour])
            3. concat all patient's file together
+           the result is persisted into IOConfig['scan_manifest'] with mtimes of each patient's folders,
+           later scans only re-scan the patients whose folders changed
            e.g. scaned file array
             [
                 [140.dcm, ...-0140-icontour-manual.txt, ...-0140-ocontour-manual.txt ],
@@ -146,22 +188,67 @@ class FileFeeder(object):
                 [220.dcm, None, None ]
             ]
         """
-        self._build_patient_contours()
+        manifest_file = os.path.join(self._directory, config.IOConfig['scan_manifest'])
+        # an unreadable manifest means a full scan
+        manifest = load_json(manifest_file)
+
+        # link.csv is only parsed again if it changed
+        link_file = os.path.join(self._directory, config.IOConfig['link_file'])
+        link_mtime = os.stat(link_file).st_mtime_ns if os.path.exists(link_file) else None
+        if manifest.get('link_mtime') == link_mtime and 'patient_contours' in manifest:
+            self._patient_contours = manifest['patient_contours']
+        else:
+            self._build_patient_contours()
+
         dicoms_path = os.path.join(self._directory, config.IOConfig['dicoms_folder'])
         base_contour_path = os.path.join(self._directory, config.IOConfig['contour_folder'])
-        patient_files = []
+        patients = []
         if os.path.exists(dicoms_path):
-            for dirname, dirnames, _ in os.walk(dicoms_path):
-                for sub_dir in dirnames:
-                    self._patient_files[sub_dir] = PatientFile(
-                        os.path.join(dicoms_path, sub_dir), 
-                        os.path.join(base_contour_path, self._patient_contours[sub_dir]))
-                    patient_files.append(self._patient_files[sub_dir].paired_files())
+            with os.scandir(dicoms_path) as entries:
+                patients = [entry.name for entry in entries if entry.is_dir()]
+
+        # only patients whose folders changed since last scan are scanned again
+        scanned = manifest.get('patients', {})
+        def scan_patient(patient_id):
+            dicoms_folder = os.path.join(dicoms_path, patient_id)
+            contour_folder = os.path.join(base_contour_path, self._patient_contours[patient_id])
+            mtimes = PatientFile.folder_mtimes(dicoms_folder, contour_folder)
+            entry = scanned.get(patient_id)
+            if entry and entry['mtimes'] == mtimes and entry['contour_folder'] == contour_folder \
+                    and entry['paths']['dicoms'] == dicoms_folder:
+                return PatientFile(dicoms_folder, contour_folder, manifest=entry), entry
+
+            patient = PatientFile(dicoms_folder, contour_folder)
+            entry = dict(patient.manifest(), mtimes=mtimes, contour_folder=contour_folder)
+            return patient, entry
+
+        # folders of different patients are independent, scan them in parallel
+        with ThreadPoolExecutor(max_workers=config.Performance['scan_workers']) as executor:
+            results = list(executor.map(scan_patient, patients))
+
+        patient_files = []
+        entries = {}
+        for patient_id, (patient, entry) in zip(patients, results):
+            self._patient_files[patient_id] = patient
+            entries[patient_id] = entry
+            patient_files.append(patient.paired_files())
         if patient_files:
             self._file_array = np.concatenate(patient_files)
             self.n = self._file_array.shape[0]
             self._iter_index = 0
 
+        new_manifest = {
+            'link_mtime': link_mtime,
+            'patient_contours': self._patient_contours,
+            'patients': entries
+        }
+        if new_manifest != manifest:
+            try:
+                dump_json(manifest_file, new_manifest)
+            except (IOError, OSError) as e:
+                # read-only dataset, next scan starts from scratch
+                print(e)
+
     def __len__(self):
         return self.n
 
@@ -182,6 +269,171 @@ class FileFeeder(object):
     def files(self):
         return self._file_array
 
+    # contour availability of a file group, index is bool(i-contour) + 2 * bool(o-contour)
+    CONTOUR_CLASSES = ('none', 'i', 'o', 'io')
+
+    @staticmethod
+    def contour_classes(files):
+        """
+        :param files: numpy array of file groups
+        :return: int array, index into CONTOUR_CLASSES of every file group, no file is opened
+        """
+        if files is None or len(files) == 0:
+            return np.zeros(0, dtype=np.int64)
+        has_i = np.array([bool(contour) for contour in files[:, 1]])
+        has_o = np.array([bool(contour) for contour in files[:, 2]])
+        return has_i + 2 * has_o
+
+    def with_contours(self, classes=('i', 'o', 'io')):
+        """File groups whose contour availability is one of classes, nothing is decoded
+           e.g. feeder.with_contours(['io']) only keeps slices having both contours
+        """
+        codes = [self.CONTOUR_CLASSES.index(name) for name in classes]
+        return self._file_array[np.isin(self.contour_classes(self._file_array), codes)]
+
+    def volumes(self):
+        """File groups of every patient sorted by instance number (slice position), nothing is decoded
+           instance numbers come from metadata(), slices without one follow sorted by their file name number
+        :return: OrderedDict patient id -> numpy array of file groups
+        """
+        metadata = self.metadata()
+        volumes = OrderedDict()
+        # files() concatenates the patients in the order of _patient_files
+        start = 0
+        for patient_id, patient in self._patient_files.items():
+            stop = start + len(patient._paired_files)
+            rows = sorted(range(start, stop), key=lambda row: self._slice_position(row, metadata[row]))
+            if rows:
+                volumes[patient_id] = self._file_array[rows]
+            start = stop
+        return volumes
+
+    def _slice_position(self, row, meta):
+        if meta is not None and meta.get('instance_number') is not None:
+            return (0, meta['instance_number'])
+        filename = os.path.splitext(os.path.basename(self._file_array[row][0]))[0]
+        return (1, int(filename) if filename.isdigit() else float('inf'))
+
+    def metadata(self):
+        """Header metadata of every DICOM, aligned with files()
+           e.g. {'width': 256, 'height': 256, 'rescale_slope': None, 'rescale_intercept': None,
+                 'patient_id': 'SCD0000101', 'instance_number': 48}
+           None if the header can't be parsed.
+           Only headers are read. The index is persisted into the data directory,
+           later runs only re-read DICOMs which are new or modified.
+        """
+        if self._metadata is None:
+            self._metadata = self._build_metadata()
+        return self._metadata
+
+    def select(self, predicate):
+        """File groups whose metadata satisfies predicate, pixel data is not touched
+           e.g. feeder.select(lambda meta: meta['width'] == 256)
+        """
+        selected = [meta is not None and predicate(meta) for meta in self.metadata()]
+        return self._file_array[np.array(selected, dtype=bool)]
+
+    def _build_metadata(self):
+        if self._file_array is None:
+            return []
+
+        metadata_file = os.path.join(self._directory, config.IOConfig['metadata_file'])
+        # an unreadable index is built again
+        entries = load_json(metadata_file)
+
+        # keys are relative to data directory, so the index moves with the data
+        metadata = []
+        changed = False
+        for dicom_file in self._file_array[:, 0]:
+            key = os.path.relpath(dicom_file, self._directory)
+            mtime = os.path.getmtime(dicom_file)
+            entry = entries.get(key)
+            if entry is None or entry['mtime'] != mtime:
+                entry = {'mtime': mtime, 'header': DICOMParser.Header(dicom_file)}
+                entries[key] = entry
+                changed = True
+            metadata.append(entry['header'])
+
+        if changed:
+            try:
+                dump_json(metadata_file, entries)
+            except (IOError, OSError) as e:
+                # read-only dataset, index is only kept in memory
+                print(e)
+        return metadata
+
+
+class PackedFileFeeder(FileFeeder):
+    """FileFeeder over a dataset pack written by PackedFileFeeder.pack
+       files() are virtual paths into the pack which DICOMParser reads from memory-mapped shards,
+       so iterators, caches and loaders work as with a FileFeeder of the original directory.
+    """
+    def __init__(self, directory):
+        self._pack = DatasetPack.open(directory)
+        super().__init__(directory)
+
+    @staticmethod
+    def pack(feeder, directory, shard_bytes=None):
+        """
+        Pack the files a FileFeeder discovered into directory
+        DICOMs are stored as they are, contours as parsed coordinates, header metadata goes into the index.
+        :param shard_bytes: size of a shard, default: config.IOConfig['pack_shard_bytes']
+        :return: PackedFileFeeder of the pack
+        """
+        # a pack of this directory opened by this process is closed, it is replaced by the new one
+        DatasetPack.evict(directory)
+        writer = PackWriter(directory, shard_bytes or config.IOConfig['pack_shard_bytes'])
+        try:
+            patients = OrderedDict()
+            for patient_id, patient in feeder._patient_files.items():
+                groups = []
+                for group in patient._paired_files:
+                    names = []
+                    for k, filename in enumerate(group):
+                        if not filename:
+                            names.append(None)
+                            continue
+                        name = os.path.relpath(filename, feeder._directory)
+                        if k == 0:
+                            with open(filename, 'rb') as fp_file:
+                                writer.add_bytes(name, fp_file.read())
+                        else:
+                            writer.add_array(name, DICOMParser.Coords(filename))
+                        names.append(name)
+                    groups.append(names)
+                patients[patient_id] = groups
+            metadata = feeder.metadata()
+        except:
+            writer.discard()
+            raise
+        writer.close({
+            'patient_contours': feeder._patient_contours,
+            'patients': patients,
+            'metadata': metadata
+        })
+        return PackedFileFeeder(directory)
+
+    def scan_files(self):
+        """file groups come from the pack index, nothing is scanned"""
+        index = self._pack.index
+        self._patient_contours = dict(index['patient_contours'])
+        patient_files = []
+        for patient_id, groups in index['patients'].items():
+            paired_files = [[self._pack.path(name) if name else None for name in group] for group in groups]
+            files = {label: [os.path.basename(group[k]) for group in groups if group[k]]
+                     for k, label in enumerate(PatientFile.FILE_SETS_LABELS)}
+            patient = PatientFile(None, None, manifest={'files': files, 'paths': {}, 'paired_files': paired_files})
+            self._patient_files[patient_id] = patient
+            patient_files.append(patient.paired_files())
+        if patient_files:
+            self._file_array = np.concatenate(patient_files)
+            self.n = self._file_array.shape[0]
+            self._iter_index = 0
+
+    def metadata(self):
+        """Header metadata stored by pack(), aligned with files()"""
+        return self._pack.index['metadata']
+
 
 class DICOMFileIterator(Iterator):
     """An implementation of utils.Iterator
@@ -189,7 +441,9 @@ class DICOMFileIterator(Iterator):
        This iterator is designed for parallel, a locker will be apply when retrieving the INDICES of next batch.
           But the locker will not affect the _process_batch_data
     """
-    def __init__(self, x, batch_size, shuffle=True, seed=None):
+    def __init__(self, x, batch_size, shuffle=True, seed=None, cache=None, dtype=None,
+                 bucket_by_size=False, metadata=None, pack_masks=False, masks='i', contour_weights=None,
+                 transform=None):
         """
         x is a numpy array of file group. e.g.
            x = [
@@ -197,17 +451,140 @@ class DICOMFileIterator(Iterator):
                ...
                [220.dcm, None, None ]
            ]
+        cache: a SliceCache (or its directory) built by SliceCache.build,
+           cached slices are read from the memmap, others are decoded as usual
+        dtype: dtype of pixel data, e.g. np.float32 or np.int16. If given, batches are assembled
+           into contiguous buffers and a batch is (batch_x, batch_y, valid), see _assemble_batch
+        bucket_by_size: a batch only holds slices of the same (width, height), no padding is needed
+        metadata: header metadata aligned with x (FileFeeder.metadata()) used for bucketing,
+           if None only the DICOM headers are read
+        pack_masks: only with dtype, batch_y is bit-packed along the last axis, 8x smaller to cache and
+           send between processes, see unpack_masks
+        masks: 'i', 'o', 'io' or 'label', which masks are rasterized, see DICOMParser.ReadDICOM.
+           The DICOM is decoded once whichever masks are asked
+        contour_weights: sample with replacement by contour availability instead of shuffling,
+           a dict of FileFeeder.CONTOUR_CLASSES -> weight of the class (missing classes are never drawn)
+           e.g. {'i': 1, 'io': 1}, or 'balanced' to draw every present class equally often
+        transform: only with dtype, a callable (batch_x, batch_y, rng) -> (batch_x, batch_y) applied to
+           every batch where it is loaded (inside workers), e.g. vessel.augment.Compose([...]).
+           rng is np.random.RandomState(batch seed) (see Iterator._batch_seed), the same whichever loader,
+           process or thread loads the batch. Without seed it is drawn from np.random
         """
+        if pack_masks and dtype is None:
+            raise ValueError("pack_masks requires dense batches, dtype must be given")
+        if masks not in DICOMParser.MASKS:
+            raise ValueError("Unknown masks [{}]".format(masks))
+        if pack_masks and masks == 'label':
+            raise ValueError("A label map can't be bit-packed")
+        if transform is not None and dtype is None:
+            raise ValueError("transform requires dense batches, dtype must be given")
         self.x = x
         self.batch_size = batch_size
         self.shuffle = shuffle
         self.seed = seed
+        self.dtype = dtype
+        self.pack_masks = pack_masks
+        self.masks = masks
+        self.transform = transform
         sample_size = 0
         if x is not None:
             sample_size = x.shape[0]
-        super().__init__(sample_size, batch_size, shuffle, seed)
 
-    def _process_batch_data(self, index_array):
+        self._decode_executor = None
+        self._decode_pid = None
+        self.cache = None
+        self._cache_rows = None
+        if cache is not None:
+            self.cache = cache if isinstance(cache, SliceCache) else SliceCache(cache)
+            # a label map is merged from cached i/o-contour masks
+            cached_masks = 'io' if masks == 'label' else masks
+            if self.cache.masks != cached_masks:
+                raise ValueError("Slice cache holds '{}' masks, '{}' are needed".format(self.cache.masks, cached_masks))
+            self._cache_rows = self.cache.rows(x)
+
+        groups = None
+        if bucket_by_size and x is not None:
+            groups = self._size_groups(x, metadata)
+        weights = None
+        if contour_weights is not None and x is not None:
+            weights = self._contour_weights(x, contour_weights)
+        super().__init__(sample_size, batch_size, shuffle, seed, groups, weights)
+
+    @staticmethod
+    def _contour_weights(x, contour_weights):
+        """
+        :return: weight of every sample, a class weight is shared by all samples of the class
+        """
+        classes = FileFeeder.contour_classes(x)
+        counts = np.bincount(classes, minlength=len(FileFeeder.CONTOUR_CLASSES))
+        if contour_weights == 'balanced':
+            contour_weights = {name: 1.0 for name, count in zip(FileFeeder.CONTOUR_CLASSES, counts) if count}
+        class_weights = np.zeros(len(FileFeeder.CONTOUR_CLASSES))
+        for name, weight in contour_weights.items():
+            class_weights[FileFeeder.CONTOUR_CLASSES.index(name)] = weight
+        # divide by class size, so weights are per class rather than per sample
+        return class_weights[classes] / np.maximum(counts[classes], 1)
+
+    @staticmethod
+    def _size_groups(x, metadata=None):
+        """
+        :return: int array, slices with the same (width, height) have the same group id
+           slices whose header can't be read are grouped together
+        """
+        if metadata is None:
+            metadata = [DICOMParser.Header(group[0]) for group in x]
+        sizes = [(meta['width'], meta['height']) if meta else (0, 0) for meta in metadata]
+        _, groups = np.unique(np.array(sizes, dtype=np.int64).reshape(-1, 2), axis=0, return_inverse=True)
+        return groups.reshape(-1)
+
+    def _read_samples(self, index_array):
+        """
+        return: list of (pixel_data, mask) in the order of index_array
+        """
+        samples = [None] * len(index_array)
+        missed = range(len(index_array))
+        if self.cache is not None:
+            rows = self._cache_rows[index_array]
+            hit = np.flatnonzero(rows >= 0)
+            for i, sample in zip(hit, self.cache.read(rows[hit], packed=self.pack_masks)):
+                if self.masks == 'label' and sample[1] is not None:
+                    sample = (sample[0], DICOMParser.LabelMap(sample[1]))
+                samples[i] = sample
+            missed = np.flatnonzero(rows < 0)
+
+        def read(i):
+            x = self.x[index_array[i]]
+            sample = DICOMParser.ReadDICOM(x[0], x[1], x[2], masks=self.masks)
+            if self.pack_masks and sample[1] is not None:
+                sample = (sample[0], np.packbits(sample[1], axis=-1))
+            return sample
+
+        executor = self._executor()
+        if executor is None:
+            for i in missed:
+                samples[i] = read(i)
+        else:
+            # map keeps the order of index_array whichever thread finishes first
+            for i, sample in zip(missed, executor.map(read, missed)):
+                samples[i] = sample
+        return samples
+
+    def _executor(self):
+        """
+        Thread pool decoding the samples of a batch, file I/O and numpy release the GIL
+        None if config.Performance['decode_threads'] <= 1
+        The pool is created lazily in every process, threads of the parent don't survive a fork
+        """
+        n_threads = config.Performance['decode_threads']
+        if n_threads <= 1:
+            return None
+        pid = os.getpid()
+        if self._decode_executor is None or self._decode_pid != pid:
+            self._decode_executor = ThreadPoolExecutor(max_workers=n_threads)
+            self._decode_pid = pid
+        return self._decode_executor
+
+    def _process_batch_data(self, index_array, seed=None):
         """
         batch_x = [
             pixel_data, 
@@ -222,23 +599,323 @@ class DICOMFileIterator(Iterator):
             mask
         ]
         return: (batch_x, batch_y)
+            or (batch_x, batch_y, valid) if dtype is given
+        """
+        samples = self._read_samples(index_array)
+        if self.dtype is not None:
+            with telemetry.timer('batch_stack'):
+                batch = self._assemble_batch(samples, index_array)
+            if self.transform is None:
+                return batch
+            with telemetry.timer('augment'):
+                return self._augment(*batch, seed=seed)
+
+        with telemetry.timer('batch_stack'):
+            batch_x = []
+            batch_y = []
+            for img, mask in samples:
+                batch_x.append(img)
+                batch_y.append(mask)
+            return (np.asarray(batch_x), np.asarray(batch_y))
+
+    def _assemble_batch(self, samples, index_array):
+        """
+        Copy samples into preallocated contiguous buffers
+        slices smaller than the largest one of the batch are zero padded at bottom/right
+        return: (batch_x, batch_y, valid)
+            batch_x: (B, H, W) array of self.dtype
+            batch_y: (B, H, W) bool array, all False if the slice has no mask
+                or (B, H, ceil(W / 8)) uint8 array if pack_masks
+                or (B, 2, H, W) (packed: (B, 2, H, ceil(W / 8))) if masks is 'io'
+                or (B, H, W) uint8 label map if masks is 'label'
+            valid: (B,) bool array, True if the slice has a mask
+                or (B, 2) if masks is 'io', True if the slice has that contour
+        """
+        shapes = np.array([img.shape for img, _ in samples])
+        height, width = shapes.max(axis=0)
+        uniform = (shapes == (height, width)).all()
+        alloc = np.empty if uniform else np.zeros
+        batch_x = alloc((len(samples), height, width), dtype=self.dtype)
+        channels = (2, ) if self.masks == 'io' else ()
+        mask_width = (width + 7) // 8 if self.pack_masks else width
+        mask_dtype = np.uint8 if self.pack_masks or self.masks == 'label' else bool
+        batch_y = np.zeros((len(samples), ) + channels + (height, mask_width), dtype=mask_dtype)
+        if self.masks == 'io':
+            valid = np.array([[bool(contour) for contour in self.x[i][1:3]] for i in index_array], dtype=bool)
+        else:
+            valid = np.zeros(len(samples), dtype=bool)
+        for i, (img, mask) in enumerate(samples):
+            h, w = img.shape
+            np.copyto(batch_x[i, :h, :w], img, casting='unsafe')
+            if mask is not None:
+                batch_y[i, ..., :h, :mask.shape[-1]] = mask
+                if self.masks != 'io':
+                    valid[i] = True
+        return (batch_x, batch_y, valid)
+
+    def _augment(self, batch_x, batch_y, valid, seed=None):
+        # transforms see plain masks, packed ones are unpacked and packed again around them
+        if self.pack_masks:
+            batch_y = self.unpack_masks(batch_y, batch_x.shape[-1])
+        # not np.random itself, batches may be loaded in threads while np.random is seeded for others
+        rng = np.random.RandomState(np.random.randint(2 ** 31 - 1) if seed is None else seed)
+        batch_x, batch_y = self.transform(batch_x, batch_y, rng)
+        if self.pack_masks:
+            batch_y = np.packbits(batch_y, axis=-1)
+        return (np.ascontiguousarray(batch_x), np.ascontiguousarray(batch_y), valid)
+
+    @staticmethod
+    def unpack_masks(batch_y, width):
+        """
+        Unpack masks of a pack_masks batch
+        :param width: width of the pixel data, e.g. batch_x.shape[-1]
+        :return: bool array, same shape as batch_y except the last axis is width
         """
-        batch_x = []
-        batch_y = []
-        for i, row in enumerate(index_array):
-            x = self.x[row]
-            img, mask = DICOMParser.ReadDICOM(x[0], x[1], x[2])
-            batch_x.append(img)
-            batch_y.append(mask)
-        return (np.asarray(batch_x), np.asarray(batch_y))
+        return np.unpackbits(batch_y, axis=-1, count=width).view(bool)
 
     def next(self):
         # lock during generate index array
         with self.index_locker:
             index_array = next(self.index_generator)
+            seed = self._batch_seed()
 
         # print("batch index array: {}".format(index_array))
         # process_batch_data can be parallel
-        return self._process_batch_data(index_array)
+        return self._process_batch_data(index_array, seed)
+
+
+class DistributedFileIterator(DICOMFileIterator):
+    """DICOMFileIterator over the shard of one rank of a data-parallel job
+       Every epoch the patients are shuffled with seed + epoch, the same way on every rank, and dealt to
+       the ranks (a patient goes to the rank holding the fewest slices so far). Shards are disjoint and the
+       slices of a patient never reach two ranks.
+       Every rank gets ceil(n / world_size) samples per epoch so all ranks run the same number of steps:
+       a smaller shard repeats some of its slices, a larger one leaves its last (shuffled) slices out.
+    """
+    def __init__(self, x, batch_size, rank, world_size, seed=0, patients=None, **kwargs):
+        """
+        rank: index of this process in [0, world_size)
+        world_size: number of processes sharing the dataset
+        seed: shared by every rank, it decides which patients go to which rank
+        patients: patient of every file group of x, default: the folder of the DICOM file (dicoms/<patient>/)
+        kwargs: other DICOMFileIterator arguments, bucket_by_size and contour_weights aren't supported
+        """
+        if not 0 <= rank < world_size:
+            raise ValueError("rank must be in [0, {}), not {}".format(world_size, rank))
+        if kwargs.get('bucket_by_size') or kwargs.get('contour_weights') is not None:
+            raise ValueError("bucket_by_size and contour_weights aren't supported with sharding")
+        if seed is None:
+            raise ValueError("A seed shared by every rank is needed")
+        if patients is None:
+            patients = [os.path.dirname(group[0]) for group in x]
+        _, self.patients = np.unique(np.asarray(patients), return_inverse=True)
+        self.patients = self.patients.reshape(-1)
+        if self.patients.max(initial=-1) + 1 < world_size:
+            raise ValueError("{} patients can't be split into {} shards".format(self.patients.max(initial=-1) + 1, world_size))
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        super().__init__(x, batch_size, seed=seed, **kwargs)
+        self.n = int(np.ceil(len(x) / float(world_size)))
+
+    @staticmethod
+    def shard(patients, rank, world_size, seed=None):
+        """
+        :param patients: int array, patient of every sample
+        :param seed: order in which patients are dealt, None: in order of patient
+        :return: sorted indices of the samples of rank
+        """
+        counts = np.bincount(patients)
+        order = np.arange(len(counts))
+        if seed is not None:
+            order = np.random.RandomState(seed).permutation(len(counts))
+        loads = np.zeros(world_size, dtype=np.int64)
+        owner = np.empty(len(counts), dtype=np.int64)
+        for patient in order:
+            owner[patient] = np.argmin(loads)
+            loads[owner[patient]] += counts[patient]
+        return np.flatnonzero(owner[patients] == rank)
+
+    def set_epoch(self, epoch):
+        """the next reshuffle deals patients as in epoch, e.g. when resuming a job"""
+        self.epoch = epoch
+
+    def _reset_index_array(self):
+        index_array = self.shard(self.patients, self.rank, self.world_size,
+                                 self.seed + self.epoch if self.shuffle else None)
+        if self.shuffle:
+            index_array = np.random.permutation(index_array)
+        # repeated or cut to the same length on every rank
+        self.index_array = np.resize(index_array, self.n)
+        self.epoch += 1
+
+
+class VolumeIterator(Iterator):
+    """An implementation of utils.Iterator over patients' volumes
+       A volume is the (Z, H, W) stack of a patient's slices sorted by instance number (FileFeeder.volumes()).
+       A batch only decodes the slices under its windows, decoded slices are kept in a per-process
+       LRU cache bounded by config.Performance['volume_cache_bytes'] and shared by neighbouring windows.
+       An epoch goes patient after patient, so a cache holding one volume decodes every slice once.
+    """
+    def __init__(self, volumes, batch_size, context=1, shuffle=True, seed=None, dtype=np.float32, masks='i'):
+        """
+        volumes: list of file arrays, one per patient, sorted by slice position
+           e.g. list(feeder.volumes().values())
+        context: neighbouring slices on each side of a sample, a sample is the (2 * context + 1, H, W)
+           window centred on a slice, edge slices are repeated beyond the volume.
+           A batch only holds windows of one patient.
+           None: a sample is a whole volume
+        dtype: dtype of pixel data
+        masks: 'i', 'o', 'io' or 'label', see DICOMParser.ReadDICOM
+        """
+        if masks not in DICOMParser.MASKS:
+            raise ValueError("Unknown masks [{}]".format(masks))
+        self.volumes = list(volumes)
+        self.context = context
+        self.dtype = dtype
+        self.masks = masks
+        self._cache = None
+        self._cache_pid = None
+
+        groups = None
+        if context is None:
+            sample_size = len(self.volumes)
+        else:
+            # sample i is slice _slices[i] of volume groups[i]
+            sizes = [len(files) for files in self.volumes]
+            groups = np.repeat(np.arange(len(sizes)), sizes)
+            self._slices = np.concatenate([np.arange(size) for size in sizes]) if sizes else np.zeros(0, dtype=np.int64)
+            sample_size = len(groups)
+        super().__init__(sample_size, batch_size, shuffle, seed, groups)
+
+    def _volume_cache(self):
+        """LRU cache of decoded slices keyed by (volume, slice), created lazily in every process"""
+        max_bytes = config.Performance['volume_cache_bytes']
+        if not max_bytes:
+            return None
+        pid = os.getpid()
+        if self._cache is None or self._cache_pid != pid:
+            self._cache = LRUCache(max_bytes)
+            self._cache_pid = pid
+        elif self._cache.max_bytes != max_bytes:
+            self._cache.resize(max_bytes)
+        return self._cache
+
+    def _group_batches(self):
+        """
+        Batches of a patient follow each other: the patient order is shuffled, then the windows of a patient,
+        every slice is decoded once an epoch if the cache holds a volume
+        """
+        batches = []
+        groups = self.groups[self.index_array]
+        order = np.unique(groups)
+        if self.shuffle:
+            order = np.random.permutation(order)
+        for group in order:
+            members = self.index_array[groups == group]
+            batches.extend(np.split(members, range(self.batch_size, len(members), self.batch_size)))
+        return batches
 
-    
\ No newline at end of file
+    def _read_slices(self, v, zs):
+        """
+        Decode slices zs of volume v in order, cached slices are not decoded again
+        return: list of (img, mask) as DICOMParser.ReadDICOM, None for a slice which can't be decoded.
+            Cached arrays are read-only
+        """
+        cache = self._volume_cache()
+        files = self.volumes[v]
+        samples = []
+        with telemetry.timer('volume_read'):
+            for z in zs:
+                key = (int(v), int(z))
+                sample = cache.get(key) if cache is not None else None
+                if sample is None:
+                    group = files[z]
+                    # False marks a slice which can't be decoded, None is a cache miss
+                    sample = DICOMParser.ReadDICOM(group[0], group[1], group[2], masks=self.masks) or False
+                    if cache is not None:
+                        arrays = [array for array in sample or () if array is not None]
+                        for array in arrays:
+                            array.flags.writeable = False
+                        cache.put(key, sample, sum(array.nbytes for array in arrays))
+                samples.append(sample or None)
+        return samples
+
+    def _stack(self, v, zs):
+        """
+        Stack slices zs of volume v, slices smaller than the largest one are zero padded
+        return: (pixels, masks, valid)
+            pixels: (Z, H, W) array of self.dtype
+            masks: (Z, H, W) bool (uint8 for 'label') or (Z, 2, H, W) bool if masks is 'io'
+            valid: (Z,) bool, True if the slice has a mask, or (Z, 2) if masks is 'io'
+        """
+        files = [self.volumes[v][z] for z in zs]
+        samples = self._read_slices(v, zs)
+        shapes = np.array([sample[0].shape for sample in samples if sample is not None]).reshape(-1, 2)
+        height, width = shapes.max(axis=0) if len(shapes) else (0, 0)
+        channels = (2, ) if self.masks == 'io' else ()
+        pixels = np.zeros((len(files), height, width), dtype=self.dtype)
+        masks = np.zeros((len(files), ) + channels + (height, width),
+                         dtype=np.uint8 if self.masks == 'label' else bool)
+        if self.masks == 'io':
+            valid = np.array([[bool(contour) for contour in group[1:3]] for group in files], dtype=bool).reshape(-1, 2)
+        else:
+            valid = np.zeros(len(files), dtype=bool)
+        for z, sample in enumerate(samples):
+            # a slice which can't be decoded stays zero
+            if sample is None:
+                if self.masks == 'io':
+                    valid[z] = False
+                continue
+            img, mask = sample
+            h, w = img.shape
+            np.copyto(pixels[z, :h, :w], img, casting='unsafe')
+            if mask is not None:
+                masks[z, ..., :h, :w] = mask
+                if self.masks != 'io':
+                    valid[z] = True
+        return (pixels, masks, valid)
+
+    def volume(self, v):
+        """(pixels, masks, valid) of volume v, see _stack"""
+        return self._stack(v, range(len(self.volumes[v])))
+
+    def _process_batch_data(self, index_array, seed=None):
+        """
+        return: (batch_x, batch_y, valid)
+            windows (context is not None), padded to the largest slice of the batch:
+                batch_x: (B, 2 * context + 1, H, W), batch_y and valid of the centre slices,
+                    shaped like DICOMFileIterator's dense batches
+            whole volumes (context is None), padded to the largest volume:
+                batch_x: (B, Z, H, W), batch_y: (B, Z, ...) masks, valid: (B, Z, ...) False for padding
+        """
+        if self.context is None:
+            volumes = [self.volume(v) for v in index_array]
+            depth = max(len(pixels) for pixels, _, _ in volumes)
+            batch = []
+            for k, array in enumerate(volumes[0]):
+                # the largest volume decides every axis, smaller ones are zero padded
+                shape = np.max([volume[k].shape for volume in volumes], axis=0)
+                shape[0] = depth
+                out = np.zeros((len(volumes), ) + tuple(shape), dtype=array.dtype)
+                for i, volume in enumerate(volumes):
+                    out[(i, ) + tuple(slice(0, n) for n in volume[k].shape)] = volume[k]
+                batch.append(out)
+            return tuple(batch)
+
+        # a batch never mixes volumes, see groups
+        v = self.groups[index_array[0]]
+        centres = self._slices[index_array]
+        offsets = np.arange(-self.context, self.context + 1)
+        windows = np.clip(centres[:, None] + offsets, 0, len(self.volumes[v]) - 1)
+        # only the slices under the windows are read, not the whole volume
+        needed = np.unique(windows)
+        pixels, masks, valid = self._stack(v, needed)
+        centres = np.searchsorted(needed, centres)
+        return (pixels[np.searchsorted(needed, windows)], masks[centres], valid[centres])
+
+    def next(self):
+        with self.index_locker:
+            index_array = next(self.index_generator)
+            seed = self._batch_seed()
+        return self._process_batch_data(index_array, seed)
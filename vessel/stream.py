@@ -0,0 +1,93 @@
+"""asyncio interface of the loaders"""
+
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import vessel.configuration as config
+
+
+class AsyncBatchStream(object):
+    """`async for` over the batches of an `Iterator` (e.g. DICOMFileIterator)
+       Index arrays are drawn in the event loop, batches are read and decoded in an executor,
+       so the loop keeps serving other tasks meanwhile.
+       At most `prefetch` batches are scheduled ahead of the consumer (backpressure), batches come
+       in the iterator's (seeded) order.
+
+       async with AsyncBatchStream(iterator, steps=100) as stream:
+           async for batch_x, batch_y in stream:
+               ...
+    """
+    def __init__(self, iterator, prefetch=None, executor=None, steps=None):
+        """
+        iterator: an `Iterator`, its _process_batch_data is called in the executor with the batch's seed
+        prefetch: how many batches are loaded ahead, default: config.Performance['cache_size']
+        executor: a concurrent.futures executor, default: a thread pool of config.Performance['max_workers']
+           threads which is shut down by close()
+        steps: stop after this many batches, None: loop forever like the iterator
+        """
+        self._iterator = iterator
+        self._prefetch = prefetch or config.Performance['cache_size']
+        self._executor = executor
+        self._own_executor = executor is None
+        self._steps = steps
+        self._scheduled = 0
+        self._pending = deque()         # futures of scheduled batches, in order
+        self._closed = False
+
+    def _schedule(self):
+        loop = asyncio.get_running_loop()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=config.Performance['max_workers'])
+        while len(self._pending) < self._prefetch and (self._steps is None or self._scheduled < self._steps):
+            with self._iterator.index_locker:
+                index_array = next(self._iterator.index_generator)
+                # np.random is shared with the executor threads, batches get their seed explicitly
+                seed = self._iterator._batch_seed()
+            self._pending.append(
+                loop.run_in_executor(self._executor, self._iterator._process_batch_data, index_array, seed))
+            self._scheduled += 1
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed:
+            raise StopAsyncIteration
+        self._schedule()
+        if not self._pending:
+            await self.aclose()
+            raise StopAsyncIteration
+
+        future = self._pending.popleft()
+        try:
+            batch = await future
+        except asyncio.CancelledError:
+            # consumer was cancelled, don't leave batches loading for nobody
+            self.close()
+            raise
+        self._schedule()
+        return batch
+
+    def close(self):
+        """Cancel the batches which haven't started, running ones finish in background"""
+        self._closed = True
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        if self._own_executor and self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    async def aclose(self):
+        """Cancel the batches which haven't started and wait until the running ones finished"""
+        self.close()
+        if self._own_executor and self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown, True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+        return False
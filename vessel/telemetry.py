@@ -0,0 +1,161 @@
+"""Opt-in instrumentation of the loading pipeline
+
+Stages record durations (seconds) or values (e.g. queue depth) into log2-bucketed histograms.
+Enabled by config.Performance['telemetry'], when disabled a timer is a shared no-op.
+"""
+
+import math
+import time
+import threading
+
+import vessel.configuration as config
+
+
+class Histogram(object):
+    """log2-bucketed histogram, bucket k holds values in [base * 2^(k-1), base * 2^k)
+       bucket 0 holds everything below base
+    """
+    N_BUCKETS = 40
+
+    def __init__(self, base):
+        self.base = base
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * self.N_BUCKETS
+
+    def add(self, value):
+        bucket = 0
+        if value >= self.base:
+            bucket = min(math.frexp(value / self.base)[1], self.N_BUCKETS - 1)
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, snapshot):
+        """add a histogram exported by snapshot()"""
+        if snapshot['count'] == 0:
+            return
+        for i, n in enumerate(snapshot['buckets']):
+            self.buckets[i] += n
+        self.count += snapshot['count']
+        self.total += snapshot['sum']
+        self.min = snapshot['min'] if self.min is None else min(self.min, snapshot['min'])
+        self.max = snapshot['max'] if self.max is None else max(self.max, snapshot['max'])
+
+    def percentile(self, q):
+        """upper edge of the bucket holding the q-th percentile, clipped to [min, max]"""
+        if self.count == 0:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return max(self.min, min(self.max, self.base * 2 ** i))
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'base': self.base,
+            'buckets': list(self.buckets)
+        }
+
+
+class _Timer(object):
+    def __init__(self, telemetry, stage):
+        self._telemetry = telemetry
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._telemetry.observe(self._stage, time.perf_counter() - self._start, Telemetry.TIME_BASE)
+        return False
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Telemetry(object):
+    """Per-process collection of stage histograms
+       e.g.
+          with telemetry.timer('pixel_read'):
+              ...
+          telemetry.snapshot()
+          # {'pixel_read': {'count': 12, 'sum': 0.03, 'mean': ..., 'p50': ..., 'p99': ..., ...}}
+    """
+    TIME_BASE = 1e-6    # durations are bucketed from 1 microsecond
+
+    def __init__(self):
+        self._histograms = {}
+        self._locker = threading.Lock()
+
+    @staticmethod
+    def enabled():
+        return config.Performance['telemetry']
+
+    def timer(self, stage):
+        """context manager recording the duration of its block"""
+        if not config.Performance['telemetry']:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def observe(self, stage, value, base=1):
+        """record a value of stage, e.g. a queue depth"""
+        if not config.Performance['telemetry']:
+            return
+        with self._locker:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram(base)
+            histogram.add(value)
+
+    def reset(self):
+        with self._locker:
+            self._histograms = {}
+
+    def snapshot(self):
+        """
+        :return: dict of stage -> histogram summary (count, sum, mean, min, max, p50, p90, p99, base, buckets)
+        """
+        with self._locker:
+            return {stage: histogram.snapshot() for stage, histogram in self._histograms.items()}
+
+    @staticmethod
+    def merge(snapshots):
+        """merge snapshots of several processes into one
+        :param snapshots: list of dicts returned by snapshot()
+        """
+        histograms = {}
+        for snapshot in snapshots:
+            for stage, summary in snapshot.items():
+                if stage not in histograms:
+                    histograms[stage] = Histogram(summary['base'])
+                histograms[stage].merge(summary)
+        return {stage: histogram.snapshot() for stage, histogram in histograms.items()}
+
+
+# telemetry of this process, workers of GeneratorQueue send theirs to the consumer
+telemetry = Telemetry()
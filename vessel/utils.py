@@ -3,14 +3,57 @@ import sys
 import logging
 import threading
 import time
+import json
+import traceback
 import multiprocessing as mp
 from abc import abstractmethod
+from collections import namedtuple, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from queue import Empty
 import numpy as np
 import vessel.configuration as config
+from vessel.telemetry import telemetry, Telemetry
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:     # python < 3.8
+    shared_memory = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+def temp_name(filename):
+    """name of a temporary file next to filename, unique to this process and thread,
+       write it completely then os.replace it over filename: readers see the old or the new file, never a partial one
+    """
+    return '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+
+
+def load_json(filename):
+    """content of a json file written by dump_json, {} if it is missing or can't be read (e.g. truncated)"""
+    if not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename, 'r') as fp_json:
+            return json.load(fp_json)
+    except (IOError, OSError, ValueError) as e:
+        print(e)
+        return {}
+
+
+def dump_json(filename, obj):
+    """write obj into filename atomically, see temp_name"""
+    temp_file = temp_name(filename)
+    try:
+        with open(temp_file, 'w') as fp_json:
+            json.dump(obj, fp_json)
+        os.replace(temp_file, filename)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+
 class Iterator(object):
     """Generic data iterator, design for batch fetching.
     Every `Iterator` must implement the `_process_batch_data`
@@ -20,23 +63,50 @@ class Iterator(object):
         :batch_size.
         :shuffle
         :seed, Random seed for reproducility
+        :groups, optional int array (n,), a batch only holds samples of the same group.
+            samples are shuffled within their group and batches are shuffled across groups
+        :weights, optional non-negative array (n,), an epoch draws n samples with replacement,
+            proportional to weights. e.g. oversample rare classes, weight 0 never draws a sample
     """
-    def __init__(self, n, batch_size, shuffle, seed):
+    def __init__(self, n, batch_size, shuffle, seed, groups=None, weights=None):
         self.n = n
         self.batch_size = batch_size
         self.seed = seed
         self.shuffle = shuffle
+        self.groups = None if groups is None else np.asarray(groups)
+        self.weights = None
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)
+            if weights.shape != (n, ) or (weights < 0).any() or weights.sum() <= 0:
+                raise ValueError("weights must be {} non-negative values, not all zero".format(n))
+            self.weights = weights / weights.sum()
         self.batch_index = 0
         self.batches_visited_counter = 0
         self.index_locker = threading.Lock()        # ensure we get the correct index array
         self.index_array = None
+        self._batches = None                        # index arrays of an epoch when grouped
         self.index_generator = self._generate_index()
 
     # re-shuffle the inner index array, usually do it for each epoch
     def _reset_index_array(self):
         self.index_array = np.arange(self.n)
-        if self.shuffle:
+        if self.weights is not None:
+            self.index_array = np.random.choice(self.n, size=self.n, replace=True, p=self.weights)
+        elif self.shuffle:
             self.index_array = np.random.permutation(self.n)
+        if self.groups is not None:
+            self._batches = self._group_batches()
+
+    def _group_batches(self):
+        """split the (shuffled) index array into batches which never mix groups"""
+        batches = []
+        groups = self.groups[self.index_array]
+        for group in np.unique(groups):
+            members = self.index_array[groups == group]
+            batches.extend(np.split(members, range(self.batch_size, len(members), self.batch_size)))
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return batches
 
     # fetch one batch
     def __getitem__(self, idx):
@@ -49,15 +119,42 @@ class Iterator(object):
         self.batches_visited_counter += 1
         if self.index_array is None:
             self._reset_index_array()
-        batch_index_array = self.index_array[self.batch_size * idx:
-                                             self.batch_size * (idx + 1)]
-        return self._process_batch_data(batch_index_array)
+        return self._process_batch_data(self._batch_index_array(idx), self._batch_seed())
+
+    def _batch_seed(self):
+        """seed of the batch drawn last (np.random was seeded with it), None if the iterator has no seed
+           call it under index_locker right after drawing the index array
+        """
+        if self.seed is None:
+            return None
+        return self.seed + self.batches_visited_counter - 1
+
+    def _batch_index_array(self, idx):
+        """index array of batch idx in the current epoch"""
+        if self.groups is not None:
+            return self._batches[idx]
+        return self.index_array[self.batch_size * idx:
+                                self.batch_size * (idx + 1)]
+
+    def _epoch_length(self):
+        """batches in the current epoch, it can vary between epochs if groups are drawn with weights"""
+        if self.groups is not None and self._batches is not None:
+            return len(self._batches)
+        return len(self)
 
     def __len__(self):
+        if self.groups is not None:
+            _, counts = np.unique(self.groups, return_counts=True)
+            return int(np.sum(np.ceil(counts / float(self.batch_size))))
         return int(np.ceil(self.n / float(self.batch_size)))
 
     def event_epoch_end(self):
-        self._reset_index_array()
+        """end the current epoch, the next batch starts a new (re-shuffled) one
+           the index array is replaced when the next batch is drawn, not under a running epoch
+        """
+        with self.index_locker:
+            self.batch_index = 0
+            self.index_array = None
 
     def reset(self):
         self.batch_index = 0
@@ -71,13 +168,19 @@ class Iterator(object):
             if self.batch_index == 0:
                 self._reset_index_array()
 
+            self.batches_visited_counter += 1
+            if self.groups is not None:
+                batch = self._batches[self.batch_index]
+                self.batch_index = (self.batch_index + 1) % len(self._batches)
+                yield batch
+                continue
+
             current_index = (self.batch_index * self.batch_size) % self.n
             if current_index + self.batch_size < self.n:
                 self.batch_index += 1
             else:
                 self.batch_index = 0
 
-            self.batches_visited_counter += 1
             yield self.index_array[current_index:
                                    current_index + self.batch_size]
 
@@ -93,9 +196,12 @@ class Iterator(object):
         pass
 
     @abstractmethod
-    def _process_batch_data(self, index_array):
+    def _process_batch_data(self, index_array, seed=None):
         """Gets a batch of preprocessed data
         :index_array, array of indices of a batch.
+        :seed, seed of the batch (see _batch_seed), None if not seeded. Random draws of a batch
+            should come from np.random.RandomState(seed) rather than np.random, loaders may run
+            batches in threads which share np.random.
         
         :return
             A batch of preprocessed data.
@@ -103,59 +209,573 @@ class Iterator(object):
         raise NotImplementedError
 
 
+class LRUCache(object):
+    """Least recently used cache bounded by bytes instead of number of entries
+       It is thread-safe, every process has its own copy.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()       # key -> (value, nbytes)
+        self._locker = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: the cached value, None if missed
+        """
+        with self._locker:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        with self._locker:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            # never hold an entry larger than the whole budget
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            self._evict()
+
+    def resize(self, max_bytes):
+        with self._locker:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.current_bytes -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        with self._locker:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class QueueTransport(object):
+    """Default transport between workers and consumer
+       every item is pickled and copied through a multiprocessing.Queue
+    """
+    def __init__(self, maxsize):
+        self._queue = mp.Queue(maxsize)
+
+    def put(self, item):
+        self._queue.put(item)
+
+    def get(self, block=True, timeout=None):
+        """
+        :return: tuple(slot, item), slot is always None for this transport
+        """
+        return None, self._queue.get(block, timeout)
+
+    def empty(self):
+        return self._queue.empty()
+
+    def qsize(self):
+        """approximate number of items in transport, None if the platform can't tell (macOS)"""
+        try:
+            return self._queue.qsize()
+        except NotImplementedError:
+            return None
+
+    def release(self, slot):
+        pass
+
+    def close(self):
+        self._queue.close()
+
+
+# placeholder of an array which has been written into a shared memory slot
+_SharedArray = namedtuple('_SharedArray', ['offset', 'shape', 'dtype'])
+
+
+class SharedBatch(tuple):
+    """A batch whose arrays are zero-copy views into a shared memory slot
+       It can be unpacked as a normal tuple. The slot goes back to the workers once
+       release() is called, after that the arrays MUST NOT be used anymore (copy them if needed).
+    """
+    def __new__(cls, items, release_fn):
+        batch = super().__new__(cls, items)
+        batch._release_fn = release_fn
+        return batch
+
+    def release(self):
+        if self._release_fn is not None:
+            self._release_fn()
+            self._release_fn = None
+
+
+class SharedMemoryTransport(object):
+    """Transport backed by a ring of preallocated shared memory slots
+       Workers write the numpy arrays of an item in place into a free slot and only send
+       a tiny layout description through the queue; the consumer rebuilds zero-copy views.
+       A slot is owned by the consumer until it is released.
+       Items that contain no array, object arrays or do not fit into one slot fall back to pickling.
+    """
+    ALIGNMENT = 64
+
+    def __init__(self, n_slots, slot_size):
+        if shared_memory is None:
+            raise RuntimeError("shared memory transport requires python >= 3.8")
+        self._slot_size = slot_size
+        self._slots = []
+        try:
+            for _ in range(n_slots):
+                self._slots.append(shared_memory.SharedMemory(create=True, size=slot_size))
+        except:
+            self.close()
+            raise
+        self._free_slots = mp.Queue()
+        for i in range(n_slots):
+            self._free_slots.put(i)
+        self._queue = mp.Queue(n_slots)
+
+    def _layout(self, item, offset):
+        """assign an aligned offset for every array of item (tuple/list are walked recursively)
+        :return: tuple(encoded item, end offset), encoded item is None if it can't be shared
+        """
+        if isinstance(item, np.ndarray):
+            if item.dtype.hasobject:
+                return None, offset
+            offset = (offset + self.ALIGNMENT - 1) // self.ALIGNMENT * self.ALIGNMENT
+            return _SharedArray(offset, item.shape, item.dtype.str), offset + item.nbytes
+        if isinstance(item, (tuple, list)):
+            encoded = []
+            for sub_item in item:
+                sub_encoded, offset = self._layout(sub_item, offset)
+                if sub_encoded is None and sub_item is not None:
+                    return None, offset
+                encoded.append(sub_encoded)
+            return type(item)(encoded), offset
+        return item, offset
+
+    def _write(self, buf, item, encoded):
+        if isinstance(encoded, _SharedArray):
+            np.ndarray(encoded.shape, encoded.dtype, buffer=buf, offset=encoded.offset)[...] = item
+        elif isinstance(encoded, (tuple, list)):
+            for sub_item, sub_encoded in zip(item, encoded):
+                self._write(buf, sub_item, sub_encoded)
+
+    def _read(self, buf, encoded):
+        if isinstance(encoded, _SharedArray):
+            return np.ndarray(encoded.shape, encoded.dtype, buffer=buf, offset=encoded.offset)
+        if isinstance(encoded, (tuple, list)):
+            return type(encoded)(self._read(buf, sub_encoded) for sub_encoded in encoded)
+        return encoded
+
+    def put(self, item):
+        encoded, size = self._layout(item, 0)
+        if encoded is None or size == 0 or size > self._slot_size:
+            # fallback: pickle the whole item
+            self._queue.put((None, item))
+            return
+
+        # block until the consumer gives a slot back
+        slot = self._free_slots.get()
+        self._write(self._slots[slot].buf, item, encoded)
+        self._queue.put((slot, encoded))
+
+    def get(self, block=True, timeout=None):
+        """
+        :return: tuple(slot, item), slot is None when the item was pickled
+        """
+        slot, encoded = self._queue.get(block, timeout)
+        if slot is None:
+            return None, encoded
+        return slot, self._read(self._slots[slot].buf, encoded)
+
+    def empty(self):
+        return self._queue.empty()
+
+    def qsize(self):
+        """approximate number of items in transport, None if the platform can't tell (macOS)"""
+        try:
+            return self._queue.qsize()
+        except NotImplementedError:
+            return None
+
+    def release(self, slot):
+        if slot is not None:
+            self._free_slots.put(slot)
+
+    def close(self):
+        for shm in self._slots:
+            try:
+                shm.close()
+            except BufferError:
+                # consumer still holds views of this slot, the mapping goes away with them
+                pass
+            shm.unlink()
+        self._slots = []
+        if hasattr(self, '_queue'):
+            self._queue.close()
+            self._free_slots.close()
+
+
+class _WorkerDone(object):
+    """sentinel sent by a worker when it exits"""
+    def __init__(self, p_id):
+        self.p_id = p_id
+
+
+class _WorkerError(object):
+    """report of an exception raised inside a worker
+       bad_indices: samples of the batch which can't be loaded, they are quarantined by consumer
+    """
+    def __init__(self, p_id, seq, trace, bad_indices):
+        self.p_id = p_id
+        self.seq = seq
+        self.trace = trace
+        self.bad_indices = bad_indices
+
+
+class _WorkerTelemetry(object):
+    """telemetry snapshot of a worker process"""
+    def __init__(self, p_id, pid, snapshot):
+        self.p_id = p_id
+        self.pid = pid
+        self.snapshot = snapshot
+
+
 class GeneratorQueue(object):
-    """Parallel a generator 
+    """Parallel a generator
        using multiprocessing to fetch data from a generator and cache into a queue
        GeneratorQueue can return another generator that retrieve data from queue
+
+       If the generator is an `Iterator`, the parent process acts as coordinator: it draws the
+       index arrays from the iterator and hands them out to the workers in strided partitions
+       (batch k goes to worker k % max_workers). Workers only run `_process_batch_data`, so every
+       batch is loaded exactly once and fetch() yields batches in the iterator's (seeded) order.
+       Any other generator is consumed by every worker independently.
+
+       Faults: an exception inside a worker is sent back with its traceback (see errors()) and
+       doesn't stop the other workers. In coordinator mode the failed batch is retried sample by
+       sample, samples which still fail are quarantined and never dispatched again, the remaining
+       samples are delivered as a smaller batch. A worker that dies (e.g. killed) is restarted at most
+       config.Performance['max_retries'] times and its unfinished batches are handed out again.
     """
-    def __init__(self, generator, seed=None):
+    def __init__(self, generator, seed=None, transport=None, auto_release=True):
         """
-        generator: a generator
+        generator: a generator or an `Iterator`
            example output of this generator
            - tuple(image array, mask array)
            The generator is expected to loop over its data indefinitely.
 
         seed: a random seed for reproducibility
+
+        transport: how batches travel from workers to consumer, default: config.Performance['transport']
+           - 'queue', pickle through multiprocessing.Queue
+           - 'shm', write into shared memory slots, fetch() yields SharedBatch of zero-copy views
+
+        auto_release: only for 'shm', release the slot of the previous batch when the next one is fetched.
+           if False, the consumer has to call batch.release() by itself
         """
-        self._wait_time = 0.05
+        self._wait_time = 0.5           # how often a starved consumer checks if workers are alive
         self._generator = generator
+        self._sharded = isinstance(generator, Iterator)
         self._processes = []
         self._max_workers = config.Performance['max_workers']
         self._cache_size = config.Performance['cache_size']
+        self._transport = transport or config.Performance['transport']
+        self._auto_release = auto_release
+        self._held_batches = []
+        self._unreleased = 0            # SharedBatch wrapped and not released yet, each takes a shm slot
         self._stop_event = None
         self._seed = seed
+        self._index_queues = []
+        self._pending = {}              # batches arrived out of order, keyed by sequence number
+        self._next_seq = 0              # sequence number of the next index array to hand out
+        self._next_yield = 0            # sequence number of the next batch to yield
+        self._finished = set()          # workers which sent _WorkerDone
+        self._in_flight = {}            # (index array, seed) dispatched but not received, keyed by sequence number
+        self._seq_epoch = {}            # epoch of the batches dispatched but not yielded, keyed by sequence number
+        self._dispatch_epoch = -1       # epoch of the last dispatched batch
+        self._quarantine = set()        # sample indices which failed to load
+        self._exhausted = False         # a whole epoch was quarantined, nothing left to dispatch
+        self._errors = []
+        self._retries = []              # restarts of every worker
+        self._worker_seeds = []
+        self._worker_telemetry = {}     # (p_id, pid) -> latest telemetry snapshot of that worker
+        self._telemetry_time = 0        # when telemetry was logged/sent last time
+        self._telemetry_period = 1.0    # how often a worker sends its telemetry, in seconds
+        self._stats = {}
         self.queue = None
 
-    def start(self):
+    def _create_transport(self):
+        if self._transport == 'queue':
+            return QueueTransport(self._cache_size)
+        if self._transport == 'shm':
+            return SharedMemoryTransport(self._cache_size, config.Performance['shm_slot_size'])
+        raise ValueError("Unknown transport [{}]".format(self._transport))
+
+    def _wrap(self, slot, item):
+        """wrap the item fetched from transport into a SharedBatch if it lives in a slot
+           the slot is counted as taken until the batch is released, by consumer or by auto release
         """
-        Start to loading data from generator
-        Since we used multiprocessing.Queue, queue.put will block the workers when reached the max size of queue
+        if slot is None:
+            return item
+
+        queue = self.queue
+        self._unreleased += 1
+
+        def release():
+            queue.release(slot)
+            # a batch of a stopped run doesn't count for the transport of the next one
+            if queue is self.queue:
+                self._unreleased -= 1
+        return SharedBatch(item, release)
+
+    def _hold(self, item):
+        """keep the batch handed to consumer, it will be released when consumer asks for the next one"""
+        if self._auto_release and isinstance(item, SharedBatch):
+            self._held_batches.append(item)
+        return item
+
+    def _release_held(self):
+        for batch in self._held_batches:
+            batch.release()
+        self._held_batches = []
+
+    def _dispatch(self):
+        """hand out index arrays to workers, at most cache_size batches are in flight
+           shm slots held by consumer are left out, otherwise later batches may take every free slot
+           while the batch consumer waits for blocks on a slot
         """
-        self._stop_event = mp.Event()
-        self.queue = mp.Queue(self._cache_size)
+        empty_draws = 0
+        # delivered batches which aren't released yet, pending ones are in flight already
+        held = self._unreleased - sum(isinstance(item, SharedBatch) for item in self._pending.values())
+        window = self._cache_size - held
+        while not self._exhausted and self._next_seq - self._next_yield < window:
+            with self._generator.index_locker:
+                # the iterator draws a new permutation with the first batch of an epoch
+                if self._generator.batch_index == 0 or self._dispatch_epoch < 0:
+                    self._dispatch_epoch += 1
+                index_array = next(self._generator.index_generator)
+                # the seed np.random had when this batch was drawn, workers load the batch with it
+                seed = self._generator._batch_seed()
+            if self._quarantine:
+                index_array = index_array[~np.isin(index_array, list(self._quarantine))]
+                if len(index_array) == 0:
+                    # every sample left may be quarantined, don't draw forever
+                    empty_draws += 1
+                    if empty_draws > self._generator._epoch_length():
+                        self._exhausted = True
+                    continue
+            empty_draws = 0
+            worker = self._next_seq % self._max_workers
+            self._in_flight[self._next_seq] = (index_array, seed)
+            self._seq_epoch[self._next_seq] = self._dispatch_epoch
+            self._index_queues[worker].put((self._next_seq, index_array, seed))
+            self._next_seq += 1
 
-        # function for sub-processes
-        def data_generator_runner(p_id):
+    # function for sub-processes
+    def _data_generator_runner(self, p_id):
+        # forked from consumer, only count what this worker does
+        telemetry.reset()
+        failures = 0
+        try:
             while not self._stop_event.is_set():
                 try:
                     item = next(self._generator)
-                    self.queue.put(item)
-                    logger.info("GeneratorQueue::Process-{} loaded data, size:({}, {})".format(p_id, item[0].shape, item[1].shape))
                 except StopIteration:
                     break
                 except Exception:
-                    self._stop_event.set()
+                    self.queue.put((None, _WorkerError(p_id, None, traceback.format_exc(), [])))
+                    # a broken generator would fail forever
+                    failures += 1
+                    if failures > config.Performance['max_retries']:
+                        break
+                    continue
+                failures = 0
+                with telemetry.timer('queue_put'):
+                    self.queue.put((None, item))
+                logger.info("GeneratorQueue::Process-{} loaded data, size:({}, {})".format(p_id, item[0].shape, item[1].shape))
+                self._send_telemetry(p_id)
+        finally:
+            self._send_telemetry(p_id, force=True)
+            self.queue.put((None, _WorkerDone(p_id)))
+
+    # function for sub-processes, only load the batches assigned by coordinator
+    def _batch_runner(self, p_id, index_queue):
+        telemetry.reset()
+        try:
+            while not self._stop_event.is_set():
+                task = index_queue.get()
+                if task is None:
+                    break
+                seq, index_array, seed = task
+                # random transforms of a batch don't depend on which worker loads it
+                if seed is not None:
+                    np.random.seed(seed)
+                try:
+                    item = self._generator._process_batch_data(index_array, seed)
+                except Exception:
+                    item = self._recover_batch(p_id, seq, index_array, seed, traceback.format_exc())
+                # None tells consumer to skip this batch
+                with telemetry.timer('queue_put'):
+                    self.queue.put((seq, item))
+                if item is not None:
+                    logger.info("GeneratorQueue::Process-{} loaded batch-{}, size:({}, {})".format(p_id, seq, item[0].shape, item[1].shape))
+                self._send_telemetry(p_id)
+        finally:
+            self._send_telemetry(p_id, force=True)
+            self.queue.put((None, _WorkerDone(p_id)))
+
+    def _send_telemetry(self, p_id, force=False):
+        """runs inside worker, send its telemetry to consumer at most once per _telemetry_period"""
+        if not Telemetry.enabled():
+            return
+        now = time.time()
+        if force or now - self._telemetry_time >= self._telemetry_period:
+            self._telemetry_time = now
+            self.queue.put((None, _WorkerTelemetry(p_id, os.getpid(), telemetry.snapshot())))
+
+    def _recover_batch(self, p_id, seq, index_array, seed, trace):
+        """
+        Runs inside worker after loading a batch failed
+        every sample is loaded alone to find the bad ones, they are reported to consumer
+        :return: the batch without bad samples, None if nothing left
+        """
+        bad_indices = []
+        for i in range(len(index_array)):
+            try:
+                self._generator._process_batch_data(index_array[i:i + 1], seed)
+            except Exception:
+                bad_indices.append(int(index_array[i]))
+        self.queue.put((None, _WorkerError(p_id, seq, trace, bad_indices)))
+
+        index_array = index_array[~np.isin(index_array, bad_indices)]
+        if len(index_array) == 0:
+            return None
+        try:
+            return self._generator._process_batch_data(index_array, seed)
+        except Exception:
+            self.queue.put((None, _WorkerError(p_id, seq, traceback.format_exc(), [])))
+            return None
+
+    def _spawn(self, p_id):
+        np.random.seed(self._worker_seeds[p_id])
+        if self._sharded:
+            p = mp.Process(target=self._batch_runner, args=(p_id, self._index_queues[p_id]))
+        else:
+            p = mp.Process(target=self._data_generator_runner, args=(p_id,))
+        p.daemon = True
+        p.start()
+        return p
+
+    def _respawn_dead_workers(self):
+        """
+        restart workers which died without finishing, e.g. killed by OOM killer or segfault
+        :return: True if any worker is alive
+        """
+        for p_id, p in enumerate(self._processes):
+            # exitcode 0: the worker finished, its _WorkerDone is on the way
+            if p.is_alive() or p.exitcode == 0 or p_id in self._finished:
+                continue
+            if self._retries[p_id] >= config.Performance['max_retries']:
+                raise RuntimeError("GeneratorQueue::Process-{} died {} times, last exitcode: {}".format(
+                    p_id, self._retries[p_id] + 1, p.exitcode))
+
+            logger.error("GeneratorQueue::Process-{} died, exitcode: {}, restarting".format(p_id, p.exitcode))
+            self._retries[p_id] += 1
+            self._stats['respawns'] += 1
+            if self._sharded:
+                # the dead process may hold the lock of its index queue, hand out its batches again
+                self._index_queues[p_id].close()
+                self._index_queues[p_id] = mp.Queue()
+                for seq in sorted(self._in_flight):
+                    if seq % self._max_workers == p_id:
+                        self._index_queues[p_id].put((seq, ) + self._in_flight[seq])
+            self._processes[p_id] = self._spawn(p_id)
+        return any(p.is_alive() for p in self._processes)
+
+    def _report(self, error):
+        """consumer side of _WorkerError"""
+        logger.error("GeneratorQueue::Process-{} failed on batch-{}\n{}".format(error.p_id, error.seq, error.trace))
+        self._quarantine.update(error.bad_indices)
+        self._stats['errors'] += 1
+        self._stats['quarantined'] = len(self._quarantine)
+        self._errors.append({
+            'worker': error.p_id,
+            'batch': error.seq,
+            'traceback': error.trace,
+            'quarantined': error.bad_indices
+        })
+
+    def errors(self):
+        """
+        :return: list of errors raised inside workers, dict of
+            worker, batch (sequence number, None if not in coordinator mode), traceback, quarantined
+        """
+        return list(self._errors)
+
+    def quarantined(self):
+        """
+        :return: sorted indices of the samples which failed to load, they are skipped from now on
+        """
+        return sorted(self._quarantine)
+
+    def start(self):
+        """
+        Start to loading data from generator
+        The transport is bounded, queue.put will block the workers when reached the max size of queue
+        """
+        self._stop_event = mp.Event()
+        self.queue = self._create_transport()
+        self._unreleased = 0
 
         # create workers
         try:
+            if self._sharded:
+                self._index_queues = [mp.Queue() for _ in range(self._max_workers)]
+                self._pending = {}
+                self._in_flight = {}
+                self._seq_epoch = {}
+                self._exhausted = False
+                self._next_seq = 0
+                self._next_yield = 0
+            self._finished = set()
+            self._worker_telemetry = {}
+            self._errors = []
+            self._retries = [0] * self._max_workers
+            self._stats = {
+                'fetched': 0, 'starved': 0, 'starved_seconds': 0.0,
+                'errors': 0, 'respawns': 0, 'quarantined': len(self._quarantine)
+            }
+
+            self._worker_seeds = []
             for i in range(self._max_workers):
-                np.random.seed(self._seed)
-                p = mp.Process(target=data_generator_runner, args=(i,))
-                p.daemon = True
+                self._worker_seeds.append(self._seed)
                 if self._seed is not None:
                     self._seed += 1
-                self._processes.append(p)
-                p.start()
+                self._processes.append(self._spawn(i))
+
+            if self._sharded:
+                self._dispatch()
         except:
             self.stop()
             raise
@@ -168,31 +788,290 @@ class GeneratorQueue(object):
             if p.is_alive():
                 p.terminate()
 
+        self._held_batches = []
+        self._pending = {}
+        self._in_flight = {}
+        self._seq_epoch = {}
         if self.queue is not None:
             self.queue.close()
+        for index_queue in self._index_queues:
+            index_queue.close()
 
         self._processes = []
+        self._index_queues = []
         self._stop_event = None
         self.queue = None
 
     def is_running(self):
         return self._stop_event is not None and not self._stop_event.is_set()
 
+    def stats(self):
+        """
+        :return: dict of
+            fetched: batches handed to consumer
+            starved: how many times consumer had to wait for workers
+            starved_seconds: total time consumer waited
+        """
+        return dict(self._stats)
+
+    def _get(self):
+        """Block until workers send something
+        :return: tuple(slot, message), None if stopped or every worker is gone
+        """
+        try:
+            return self.queue.get(block=False)
+        except Empty:
+            pass
+
+        # The consumer may faster than producer
+        self._stats['starved'] += 1
+        start = time.time()
+        try:
+            while self.is_running():
+                try:
+                    return self.queue.get(timeout=self._wait_time)
+                except Empty:
+                    # a crashed worker can't send its sentinel
+                    if not self._respawn_dead_workers():
+                        return self.queue.get(block=False)
+        except Empty:
+            pass
+        finally:
+            self._stats['starved_seconds'] += time.time() - start
+        return None
+
+    def _delivered(self, item):
+        """bookkeeping of a batch handed to consumer"""
+        self._stats['fetched'] += 1
+        if Telemetry.enabled():
+            # batches which are ready for consumer
+            depth = self.queue.qsize()
+            if depth is not None:
+                telemetry.observe('queue_depth', depth + len(self._pending))
+            self._log_telemetry()
+        return item
+
+    def telemetry(self):
+        """Telemetry of consumer and workers merged, see vessel.telemetry
+        :return: dict of stage -> histogram summary, durations are in seconds
+        """
+        return Telemetry.merge([telemetry.snapshot()] + list(self._worker_telemetry.values()))
+
+    def _log_telemetry(self):
+        """append a json line to config.Performance['telemetry_log'] every 'telemetry_interval' seconds"""
+        log_file = config.Performance['telemetry_log']
+        now = time.time()
+        if not log_file or now - self._telemetry_time < config.Performance['telemetry_interval']:
+            return
+        self._telemetry_time = now
+        record = {'time': now, 'queue': self.stats(), 'stages': self.telemetry()}
+        try:
+            with open(log_file, 'a') as fp_log:
+                fp_log.write(json.dumps(record) + '\n')
+        except (IOError, OSError) as e:
+            print(e)
+
+    def _next_batch(self, epoch=None):
+        """
+        :param epoch: only a batch of this epoch (coordinator mode), None: any batch
+        :return: next batch in order, None if stopped, every worker finished or the epoch is over
+        """
+        if self._sharded:
+            # slots released since the last batch widen the window
+            self._dispatch()
+        while self.is_running():
+            if self._exhausted and self._next_yield == self._next_seq:
+                raise RuntimeError("Every sample is quarantined, nothing left to load, see quarantined()")
+            if self._sharded and self._next_yield == self._next_seq:
+                raise RuntimeError("Every shared memory slot is held by a batch, release() some before fetching")
+            if epoch is not None and self._seq_epoch.get(self._next_yield) != epoch:
+                return None
+            if self._next_yield in self._pending:
+                item = self._pending.pop(self._next_yield)
+                self._seq_epoch.pop(self._next_yield, None)
+                self._next_yield += 1
+                if item is None:
+                    # every sample of this batch is quarantined
+                    self._dispatch()
+                    continue
+                # held before dispatching, its slot isn't free for the next batches
+                item = self._hold(self._delivered(item))
+                self._dispatch()
+                return item
+            if len(self._finished) == len(self._processes):
+                return None
+
+            with telemetry.timer('queue_get'):
+                received = self._get()
+            if received is None:
+                return None
+            slot, (seq, item) = received
+            if isinstance(item, _WorkerDone):
+                self._finished.add(item.p_id)
+                continue
+            if isinstance(item, _WorkerError):
+                self._report(item)
+                continue
+            if isinstance(item, _WorkerTelemetry):
+                self._worker_telemetry[(item.p_id, item.pid)] = item.snapshot
+                continue
+            if seq is None:
+                return self._hold(self._delivered(self._wrap(slot, item)))
+            if seq < self._next_yield or seq in self._pending:
+                # loaded twice, by a worker which died and by its replacement
+                self.queue.release(slot)
+                continue
+            # keep the order given by coordinator
+            self._in_flight.pop(seq, None)
+            self._pending[seq] = self._wrap(slot, item)
+        return None
+
     def fetch(self):
         """Creates another generator to fetch data from the queue.
+           It blocks until the next batch arrives and ends when every worker finished.
         :return, A generator
         """
-        while self.is_running():
-            if not self.queue.empty():
-                item = self.queue.get()
-                if item is not None:
-                    yield item
-            else:
-                # The consumer may faster than producer
-                # waiting workers to load data
-                all_finished = all([not p.is_alive() for p in self._processes])
-                if all_finished and self.queue.empty():
-                    raise StopIteration()
-                else:
-                    print('queue empty, loading data...')
-                    time.sleep(self._wait_time)
+        while True:
+            # consumer came back, it is done with the previous batch
+            if self._auto_release:
+                self._release_held()
+
+            item = self._next_batch()
+            if item is None:
+                return
+            yield item
+
+    def epoch(self):
+        """Generator of the batches of the current epoch, only if the generator is an `Iterator`
+           It ends after the last batch of the epoch, i.e. exactly one pass over the iterator
+           (the rest of it if fetch() already took some batches).
+           Dispatching doesn't stop at the epoch boundary: the next permutation is drawn by the parent
+           and the first batches of the next epoch are loading while this one drains.
+           for epoch in range(epochs):
+               for x, y in queue.epoch():
+                   ...
+        """
+        if not self._sharded:
+            raise ValueError("Epochs need an Iterator as generator")
+        current = self._seq_epoch.get(self._next_yield)
+        while True:
+            if self._auto_release:
+                self._release_held()
+
+            item = self._next_batch(current)
+            if item is None:
+                return
+            yield item
+
+    def fetch_many(self, k):
+        """Fetch k batches at once
+           For 'shm' transport k can't exceed the cache size, every batch holds a slot until released.
+        :return: list of batches, shorter than k if every worker finished
+        """
+        if self._transport == 'shm' and k > self._cache_size:
+            raise ValueError("Can't hold {} batches with {} shared memory slots".format(k, self._cache_size))
+        if self._auto_release:
+            self._release_held()
+
+        batches = []
+        while len(batches) < k:
+            item = self._next_batch()
+            if item is None:
+                break
+            batches.append(item)
+        return batches
+
+
+# the Iterator of a MapLoader worker, set once by _init_map_worker
+_map_iterator = None
+
+
+def _init_map_worker(iterator):
+    global _map_iterator
+    _map_iterator = iterator
+
+
+def _load_map_batch(index_array, seed):
+    if seed is not None:
+        np.random.seed(seed)
+    return _map_iterator._process_batch_data(index_array, seed)
+
+
+class MapLoader(object):
+    """Map-style parallel loader of an `Iterator`
+       The parent computes the index arrays of an epoch and the seed of every batch, a process pool
+       only runs `_process_batch_data`. Batches come in order, and because nothing depends on which
+       worker loads a batch, the output is the same for any number of workers (0: load in-process).
+
+       Like `__getitem__`, np.random is seeded with iterator.seed + (number of batches before) for
+       every batch, the index array of an epoch is drawn with the seed of its first batch.
+
+       for epoch in range(epochs):
+           for batch_x, batch_y in loader:
+               ...
+    """
+    def __init__(self, iterator, max_workers=None, prefetch=None):
+        """
+        iterator: an `Iterator`, e.g. DICOMFileIterator
+        max_workers: processes of the pool, default: config.Performance['max_workers']
+        prefetch: batches loaded ahead of the consumer, default: config.Performance['cache_size']
+        """
+        self._iterator = iterator
+        self._max_workers = config.Performance['max_workers'] if max_workers is None else max_workers
+        self._prefetch = prefetch or config.Performance['cache_size']
+        self._executor = None
+        self._epoch = 0
+        self._visited = 0           # batches of the previous epochs, the seed of the next one is based on it
+
+    def start(self):
+        if self._executor is None and self._max_workers > 0:
+            # fork: the iterator is inherited by workers, it doesn't need to be picklable
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._max_workers, mp_context=mp.get_context('fork'),
+                initializer=_init_map_worker, initargs=(self._iterator, ))
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __len__(self):
+        return len(self._iterator)
+
+    def __iter__(self):
+        return self.epoch()
+
+    def _load(self, index_array, seed):
+        if self._executor is None:
+            if seed is not None:
+                np.random.seed(seed)
+            return self._iterator._process_batch_data(index_array, seed)
+        return self._executor.submit(_load_map_batch, index_array, seed)
+
+    def epoch(self):
+        """Generator of the batches of the next epoch, in order"""
+        self.start()
+        iterator = self._iterator
+        base_seed = None if iterator.seed is None else iterator.seed + self._visited
+        if base_seed is not None:
+            np.random.seed(base_seed)
+        iterator._reset_index_array()
+        n_batches = iterator._epoch_length()
+        self._epoch += 1
+        self._visited += n_batches
+
+        pending = deque()
+        next_idx = 0
+        try:
+            while next_idx < n_batches or pending:
+                while next_idx < n_batches and len(pending) < self._prefetch:
+                    seed = None if base_seed is None else base_seed + next_idx
+                    pending.append(self._load(iterator._batch_index_array(next_idx), seed))
+                    next_idx += 1
+                item = pending.popleft()
+                yield item if self._executor is None else item.result()
+        finally:
+            # consumer stopped early, drop the batches nobody will read
+            for future in pending:
+                if self._executor is not None:
+                    future.cancel()